@@ -1,27 +1,122 @@
 import os
+import json
+import shutil
+import tarfile
 import subprocess
+from fnmatch import fnmatch
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from tqdm import tqdm
+from file_utils import file_signature
 
-# Function to apply "arcsiextractdata.py" command to zipped files within subfolders within an input directory
-def extract_landsat_data(raw_base_dir, temp_dir):
+# Record of extracted archives kept in the temp directory so reruns skip them
+MANIFEST_NAME = "extracted_manifest.json"
+
+
+# Function to find the .tar files in subfolders, grouped by the folder containing them
+def find_tar_files(raw_base_dir):
+    tar_dirs = {}
+    for root, dirs, files in os.walk(raw_base_dir):
+        for file in files:
+            if file.endswith('.tar'):
+                tar_dirs.setdefault(root, []).append(os.path.join(root, file))
+    return tar_dirs
+
+
+def load_manifest(temp_dir):
+    manifest_path = os.path.join(temp_dir, MANIFEST_NAME)
+    if os.path.exists(manifest_path):
+        with open(manifest_path) as f:
+            return json.load(f)
+    return {}
+
+
+def save_manifest(temp_dir, manifest):
+    manifest_path = os.path.join(temp_dir, MANIFEST_NAME)
+    with open(manifest_path + '.tmp', 'w') as f:
+        json.dump(manifest, f, indent=2)
+    os.replace(manifest_path + '.tmp', manifest_path)
+
+
+# Function to apply "arcsiextractdata.py" to a directory, which extracts every archive within it
+def run_arcsi_extract(input_dir, temp_dir):
+    extract_command = f'arcsiextractdata.py -i "{input_dir}" -o "{temp_dir}"'
+    result = subprocess.run(extract_command, shell=True)
+    return result.returncode == 0
+
+
+# Function to stream a .tar and extract only the members matching member_patterns (e.g. '*_B4.TIF') into
+# temp_dir/<archive name>, the same layout arcsiextractdata.py produces
+def extract_tar_members(tar_path, temp_dir, member_patterns=None):
+    scene_dir = os.path.join(temp_dir, os.path.basename(tar_path)[:-len('.tar')])
+    if not os.path.exists(scene_dir):
+        os.makedirs(scene_dir)
+
+    with tarfile.open(tar_path, 'r|*') as tar:
+        for member in tar:
+            name = os.path.basename(member.name)
+            if not member.isfile():
+                continue
+            if member_patterns and not any(fnmatch(name, pattern) for pattern in member_patterns):
+                continue
+            with tar.extractfile(member) as src, open(os.path.join(scene_dir, name), 'wb') as dst:
+                shutil.copyfileobj(src, dst, 1024 * 1024)
+    return True
+
+
+# Function to extract the zipped files within subfolders within an input directory. Each folder is extracted
+# once, up to `workers` at a time, and archives recorded in the manifest are skipped on reruns. With
+# method='tarfile' archives are streamed in Python instead of through arcsiextractdata.py, and
+# member_patterns limits extraction to the files that are actually used.
+def extract_landsat_data(raw_base_dir, temp_dir, workers=1, method='arcsi', member_patterns=None):
 
     # Check for and create temp directory
     if not os.path.exists(temp_dir):
         os.makedirs(temp_dir)
         print("Created temp directory {}".format(temp_dir))
 
-    # Run command through all subfolders
-    for root, dirs, files in tqdm(os.walk(raw_base_dir), desc="Extracting landsat data"):
-        for file in files:
-            if file.endswith('.tar'):
-                input_dir = root  # Use the directory containing the .tar file
-                extract_command = f"arcsiextractdata.py -i {input_dir} -o {temp_dir}"
-                subprocess.run(extract_command, shell=True)
-                tqdm.write(f"Extracted data from {input_dir} to {temp_dir}")
+    manifest = load_manifest(temp_dir)
+
+    # Build a deduplicated job list of archives not yet extracted
+    jobs = []
+    for input_dir, tar_files in find_tar_files(raw_base_dir).items():
+        pending = [tar_file for tar_file in tar_files if manifest.get(tar_file) != file_signature(tar_file)]
+        if not pending:
+            continue
+        if method == 'tarfile':
+            jobs.extend((input_dir, [tar_file]) for tar_file in pending)
+        else:
+            # arcsiextractdata.py extracts a whole directory, so run it once per directory
+            jobs.append((input_dir, tar_files))
+
+    # Run jobs through a bounded pool of workers
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = {}
+        for input_dir, tar_files in jobs:
+            if method == 'tarfile':
+                future = executor.submit(extract_tar_members, tar_files[0], temp_dir, member_patterns)
+            else:
+                future = executor.submit(run_arcsi_extract, input_dir, temp_dir)
+            futures[future] = (input_dir, tar_files)
+
+        for future in tqdm(as_completed(futures), total=len(futures), desc="Extracting landsat data"):
+            input_dir, tar_files = futures[future]
+            try:
+                succeeded = future.result()
+            except Exception as e:
+                tqdm.write(f"Failed to extract data from {input_dir}: {e}")
+                continue
+            if not succeeded:
+                tqdm.write(f"Failed to extract data from {input_dir}")
+                continue
+            for tar_file in tar_files:
+                manifest[tar_file] = file_signature(tar_file)
+            save_manifest(temp_dir, manifest)
+            tqdm.write(f"Extracted data from {input_dir} to {temp_dir}")
 
 
 # Script directories
 if __name__ == "__main__":
     raw_base_directory = r"C:\Users\powelj\Documents\Aotea_test_files\Landsat\RAW"
     temp_directory = r"C:\Users\powelj\Documents\Aotea_test_files\Landsat\tmp"
-    extract_landsat_data(raw_base_directory, temp_directory)
+    workers = 4
+    extract_landsat_data(raw_base_directory, temp_directory, workers)
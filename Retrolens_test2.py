@@ -1,101 +1,19 @@
-import os
-import pandas as pd
-import rasterio
-from rasterio.transform import from_origin, Affine
-from pyproj import Transformer
-from PIL import Image
-import numpy as np
-
-def convert_coordinates(lat, lon):
-    transformer = Transformer.from_crs("EPSG:4326", "EPSG:2193", always_xy=True)
-    easting, northing = transformer.transform(lon, lat)
-    return easting, northing
-
-def process_images(input_dir, output_dir, rotation_correction):
-    if not os.path.exists(output_dir):
-        os.makedirs(output_dir)
-
-    for filename in os.listdir(input_dir):
-        if filename.endswith(".jpg"):
-            image_path = os.path.join(input_dir, filename)
-            csv_filename = filename.replace("Crown_", "").replace(".jpg", ".csv")
-            csv_path = os.path.join(input_dir, csv_filename)
-
-            if os.path.exists(csv_path):
-                try:
-                    # Read the CSV file
-                    metadata = pd.read_csv(csv_path, header=0)
-                    lat = -0.0057 + float(metadata.at[0, 'Photo_Centre_Lat'])
-                    lon = -0.0163 + float(metadata.at[0, 'Photo_Centre_Long'])
-                    # lat = -0.0 + float(metadata.at[0, 'Photo_Centre_Lat'])
-                    # lon = -0.0 + float(metadata.at[0, 'Photo_Centre_Long'])
-                    altitude = float(metadata.at[0, 'Altitude'])
-                    scale = float(metadata.at[0, 'Scale'])
-                    date = str(metadata.at[0, 'Date'])
-                    image_name = str(metadata.at[0, 'Name'])
-
-                    # Convert coordinates from EPSG:4326 to EPSG:2193
-                    easting, northing = convert_coordinates(lat, lon)
-
-                    # Open the image
-                    img = Image.open(image_path)
-
-                    # Crop the image
-                    width, height = img.size
-                    left = 162
-                    right = width - 320
-                    top = 130
-                    bottom = height - 232
-                    img = img.crop((left, top, right, bottom))
-
-                    # Rotate the image
-                    # img = img.rotate(-90, expand=True)
-
-                    # Convert to numpy array for dimension info
-                    img_array = np.array(img)
-                    width, height = img.size
-
-                    # Calculate the new transform
-                    transform = from_origin(easting, northing, altitude / scale, altitude / scale)
-
-                    # Apply rotation correction
-                    rotation_correction_rad = np.deg2rad(rotation_correction)
-                    # new_transform = transform * Affine.rotation(rotation_correction_rad, (0, 0))
-                    new_transform = transform * Affine.rotation(rotation_correction_rad, (width / 2, height / 2))
-
-                    # Define the metadata
-                    meta = {
-                        'driver': 'GTiff',
-                        'height': img_array.shape[0],
-                        'width': img_array.shape[1],
-                        'count': 3,  # Assuming RGB image
-                        'dtype': img_array.dtype,
-                        'crs': 'EPSG:2193',
-                        'transform': new_transform
-                    }
-
-                    output_filename = f"{image_name}_{date}.tif"
-                    output_path = os.path.join(output_dir, output_filename)
-
-                    # Save as GeoTIFF
-                    with rasterio.open(output_path, 'w', **meta) as dst:
-                        for i in range(1, 4):  # Write 3 channels (RGB)
-                            dst.write(img_array[:, :, i - 1], i)
-                        # Add metadata
-                        for key, value in metadata.iloc[0].items():
-                            if pd.notnull(metadata.at[0, key]):
-                                dst.update_tags(**{key: str(metadata.at[0, key])})
-
-                    print(f"Processed {filename} to {output_filename}")
-
-                except Exception as e:
-                    print(f"Failed to process {filename}: {e}")
-
-
-input_directory = r'C:\Users\powelj\Documents\Aotea_test_files\Retrolens\Inputs\original'
-output_directory = r'C:\Users\powelj\Documents\Aotea_test_files\Retrolens\Outputs'
-rotation_angle = 4830
-# 90 degrees rotation_angle = 5156.5
-# rotation_angle = 4830
-
-process_images(input_directory, output_directory, rotation_angle)
+from retrolens import process_images
+
+
+if __name__ == '__main__':
+    input_directory = r'C:\Users\powelj\Documents\Aotea_test_files\Retrolens\Inputs\original'
+    output_directory = r'C:\Users\powelj\Documents\Aotea_test_files\Retrolens\Outputs'
+    rotation_angle = 4830
+    # 90 degrees rotation_angle = 5156.5
+    # rotation_angle = 4830
+    crop = (162, 130, 320, 232)  # (left, top, right, bottom) margins in pixels
+    lat_offset = -0.0057
+    lon_offset = -0.0163
+    # lat_offset = -0.0
+    # lon_offset = -0.0
+    draft = 4  # Decode scans at 1/2, 1/4 or 1/8 resolution for quick offset tuning, 1 for full resolution
+    workers = 4  # Number of frames processed in parallel
+
+    process_images(input_directory, output_directory, rotation_angle, crop=crop, lat_offset=lat_offset,
+                   lon_offset=lon_offset, draft=draft, workers=workers)
@@ -1,96 +1,17 @@
 import os
-import math
 import numpy as np
-import pandas as pd
-import rasterio
 import rasterio as rio
-from rasterio.transform import from_origin
-from rasterio.transform import Affine
-from rasterio.warp import calculate_default_transform, reproject, Resampling
-from PIL import Image
-from osgeo import gdal  # For read and manipulate rasters
+from rasterio.warp import reproject, Resampling
 from affine import Affine  # For easy manipulation of affine matrix
-from skimage import transform as sk_transform
-from skimage.transform import rotate
-
-def process_images(input_dir, temp_dir, output_dir):
-    gdal.UseExceptions()
-    if not os.path.exists(output_dir):
-        os.makedirs(output_dir)
-    if not os.path.exists(temp_dir):
-        os.makedirs(temp_dir)
-
-    for filename in os.listdir(input_dir):
-        if filename.endswith(".jpg"):
-            image_path = os.path.join(input_dir, filename)
-            csv_filename = filename.replace("Crown_", "").replace(".jpg", ".csv")
-            csv_path = os.path.join(input_dir, csv_filename)
-
-            if os.path.exists(csv_path):
-                try:
-                    # Read the CSV file
-                    metadata = pd.read_csv(csv_path, header=0)
-                    lat = 0.00 + float(metadata.at[0, 'Photo_Centre_Lat'])
-                    lon = -0.00 + float(metadata.at[0, 'Photo_Centre_Long'])
-                    scale = 0.1 / float(metadata.at[0, 'Scale'])
-                    date = str(metadata.at[0, 'Date'])
-                    image_name = str(metadata.at[0, 'Name'])
-
-                    # Open the image
-                    img = Image.open(image_path)
-                    # Crop the image
-                    width, height = img.size
-                    left = 160
-                    right = width - 310
-                    top = 120
-                    bottom = height - 225
-                    img = img.crop((left, top, right, bottom))
-
-                    # Rotate the image 270 degrees
-                    img = img.rotate(-90, expand=True)
-                    # img = img.rotate(0, expand=True)
-                    img_array = np.array(img)
-
-                    # Calculate the new width and height after rotation
-                    new_width, new_height = img.size
-                    print(new_height)
-                    print(new_width)
-
-                    # Define the transform
-                    transform_1 = from_origin(lon, lat, scale, scale)
-
-                    # Define the metadata
-                    meta = {
-                        'driver': 'GTiff',
-                        'height': new_height,
-                        'width': new_width,
-                        'count': 3,
-                        'dtype': img_array.dtype,
-                        'crs': 'EPSG:4326',
-                        'transform': transform_1
-                    }
-                    print(height)
-                    print(width)
-                    temp_filename = f"temp_{image_name}_{date}.tif"
-                    temp_path = os.path.join(temp_dir, temp_filename)
-
-                    # Save as GeoTIFF
-                    with rasterio.open(temp_path, 'w', **meta) as dst:
-                        for i in range(1, 4):
-                            dst.write(img_array[:, :, i - 1], i)
-                        # Add metadata
-                        for key, value in metadata.iloc[0].items():
-                            if pd.notnull(metadata.at[0, key]):
-                                dst.update_tags(**{key: str(metadata.at[0, key])})
-
-                    print(f"Processed {filename} to {temp_filename}")
-                    print(lat)
-                    print(lon)
-
-                except Exception as e:
-
-                    print(f"Failed to process {filename}: {e}")
-    return(temp_path)
+from retrolens import process_images as georeference_images
+
+def process_images(input_dir, temp_dir, output_dir, workers=1):
+    # Crop each image, rotate it 270 degrees and write it in EPSG:4326 to the temp directory. output_dir is
+    # no longer used here, rotate_raster takes its own output directory.
+    temp_paths = georeference_images(input_dir, temp_dir, crop=(160, 120, 310, 225), rotate=-90,
+                                     dst_crs='EPSG:4326', ground_distance=0.1, output_prefix='temp_',
+                                     workers=workers)
+    return temp_paths[-1] if temp_paths else None
 
 def raster_center(raster):
     """This function return the pixel coordinates of the raster center
@@ -184,13 +105,19 @@ def rotate_raster(in_file, out_dir, angle, shift_x=0, shift_y=0,adj_width=0, adj
                       resampling=Resampling.nearest)
 
 
-input_directory = r'C:\Users\powelj\Documents\Aotea_test_files\Retrolens\Inputs'
-temp_directory = r'C:\Users\powelj\Documents\Aotea_test_files\Retrolens\tmp'
-output_directory = r'C:\Users\powelj\Documents\Aotea_test_files\Retrolens\Outputs'
-angle = 0
-process_images(input_directory, temp_directory, output_directory)
-# temp_path = process_images(input_directory, temp_directory, output_directory)
-# dataset_src = gdal.Open(temp_path)
-# center = raster_center(dataset_src)
-# print(center)
-# rotate_raster(temp_path, output_directory, angle)
+if __name__ == '__main__':
+    input_directory = r'C:\Users\powelj\Documents\Aotea_test_files\Retrolens\Inputs'
+    temp_directory = r'C:\Users\powelj\Documents\Aotea_test_files\Retrolens\tmp'
+    output_directory = r'C:\Users\powelj\Documents\Aotea_test_files\Retrolens\Outputs'
+    angle = 0
+    process_images(input_directory, temp_directory, output_directory)
+    # from osgeo import gdal
+    # temp_path = process_images(input_directory, temp_directory, output_directory)
+    # dataset_src = gdal.Open(temp_path)
+    # center = raster_center(dataset_src)
+    # print(center)
+    # rotate_raster(temp_path, output_directory, angle)
+    # Or rotate the transform in place without resampling, and warp to north-up only once the angle is right
+    # from retrolens import correct_georeference, warp_north_up
+    # correct_georeference(temp_path, angle)
+    # warp_north_up(temp_path, os.path.join(output_directory, 'rotated_raster.tif'), num_threads=4)
@@ -0,0 +1,53 @@
+import time
+import warnings
+import numpy as np
+from composite2 import nanmedian
+
+
+def make_stack(num_images, num_bands, rows, cols, nodata, nodata_fraction, seed=0):
+    """
+    Create a random uint16 reflectance stack with a fraction of nodata pixels.
+    """
+    rng = np.random.default_rng(seed)
+    stack = rng.integers(1, 10000, size=(num_images, num_bands, rows, cols), dtype=np.uint16)
+    stack[rng.random(stack.shape) < nodata_fraction] = nodata
+    return stack
+
+
+def time_numpy_nanmedian(stack, nodata):
+    """
+    Time the float32 conversion, NaN masking and np.nanmedian used previously.
+    """
+    start = time.perf_counter()
+    data = stack.astype(np.float32)
+    data[data == nodata] = np.nan
+    with warnings.catch_warnings():
+        warnings.filterwarnings(action='ignore', message='All-NaN slice encountered')
+        result = np.nanmedian(data, axis=0)
+    return time.perf_counter() - start, result
+
+
+def time_native_nanmedian(stack, nodata):
+    """
+    Time the native dtype reducer.
+    """
+    start = time.perf_counter()
+    result = nanmedian(stack, stack != nodata)
+    return time.perf_counter() - start, result
+
+
+def run_benchmark(scene_counts, num_bands, rows, cols, nodata=0, nodata_fraction=0.3):
+    print(f"Window of {num_bands} bands x {rows} x {cols} pixels, {nodata_fraction:.0%} nodata")
+    print(f"{'scenes':>8} {'np.nanmedian (s)':>18} {'nanmedian (s)':>15} {'speedup':>9} {'equal':>7}")
+    for num_images in scene_counts:
+        stack = make_stack(num_images, num_bands, rows, cols, nodata, nodata_fraction)
+        numpy_time, numpy_result = time_numpy_nanmedian(stack, nodata)
+        native_time, native_result = time_native_nanmedian(stack, nodata)
+        equal = np.array_equal(numpy_result, native_result, equal_nan=True)
+        print(f"{num_images:>8} {numpy_time:>18.3f} {native_time:>15.3f} {numpy_time / native_time:>8.1f}x "
+              f"{str(equal):>7}")
+
+
+if __name__ == "__main__":
+    scene_counts = [10, 50, 200]
+    run_benchmark(scene_counts, num_bands=4, rows=256, cols=256)
@@ -1,4 +1,5 @@
 import os
+from concurrent.futures import ProcessPoolExecutor, as_completed
 import numpy as np
 import rasterio
 from tqdm import tqdm
@@ -49,9 +50,12 @@ def compute_median_composite(image_files, output_file):
             dst.write(median_image[band], band + 1)
 
 
-def create_median_composites(output_directory, composite_directory, file_suffix):
+def create_median_composites(output_directory, composite_directory, file_suffix, workers=1):
     """
     Create median composites for each year in the output directory.
+
+    With workers > 1 the years are composited in parallel on a process pool, each worker writing its own
+    year's output file.
     """
     if not os.path.exists(composite_directory):
         os.makedirs(composite_directory)
@@ -59,22 +63,34 @@ def create_median_composites(output_directory, composite_directory, file_suffix)
     year_folders = [os.path.join(output_directory, d) for d in os.listdir(output_directory) if
                     os.path.isdir(os.path.join(output_directory, d))]
 
-    for year_folder in tqdm(year_folders, desc="Creating composites"):
+    jobs = []
+    for year_folder in year_folders:
         year = os.path.basename(year_folder)
         image_files = get_image_files(year_folder, file_suffix)
 
         if image_files:
             output_file = os.path.join(composite_directory, f"{year}_median_composite.tif")
-            compute_median_composite(image_files, output_file)
+            jobs.append((image_files, output_file))
             '''tqdm.write(f"Created median composite for year {year}: {output_file}")  # Terminal output
         else:
             tqdm.write(f"No images found for year {year} with suffix {file_suffix}")  # Terminal output'''
 
+    if workers > 1:
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            futures = [executor.submit(compute_median_composite, image_files, output_file)
+                       for image_files, output_file in jobs]
+            for future in tqdm(as_completed(futures), total=len(futures), desc="Creating composites"):
+                future.result()
+    else:
+        for image_files, output_file in tqdm(jobs, desc="Creating composites"):
+            compute_median_composite(image_files, output_file)
+
 
 # Parameters
 output_directory = r"C:\Users\powelj\Documents\Aotea_test_files\Sentinel\Outputs"
 composite_directory = r"C:\Users\powelj\Documents\Aotea_test_files\Sentinel\Composites"
 file_suffix = "_mclds_topshad_rad_srefdem_stdsref.tif"
+workers = 1  # Number of years to composite in parallel
 
 if __name__ == "__main__":
-    create_median_composites(output_directory, composite_directory, file_suffix)
+    create_median_composites(output_directory, composite_directory, file_suffix, workers)
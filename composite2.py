@@ -1,15 +1,32 @@
 import os
+import json
+import math
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from contextlib import ExitStack
+from functools import cached_property, partial
 import numpy as np
 import rasterio
+from rasterio.crs import CRS
+from rasterio.enums import Resampling
 from rasterio.errors import RasterioIOError
+from rasterio.transform import from_origin
+from rasterio.vrt import WarpedVRT
+from rasterio.warp import transform_bounds
+from rasterio.windows import Window
 from tqdm import tqdm
-import warnings
+from scene_index import SceneIndex
+from output_profile import get_output_meta, finalize_output
+from file_utils import file_signature
 
 
-def get_image_files(year_folder, file_suffix):
+def get_image_files(year_folder, file_suffix, index=None):
     """
-    Retrieve all image files with the specified suffix from the given folder.
+    Retrieve all image files with the specified suffix from the given folder, using the scene index's cached
+    directory listings if one is given.
     """
+    if index is not None:
+        return index.list_files(year_folder, file_suffix)
+
     image_files = []
     for root, dirs, files in os.walk(year_folder):
         for file in files:
@@ -18,9 +35,11 @@ def get_image_files(year_folder, file_suffix):
     return image_files
 
 
-def validate_geotiffs(image_files):
+def validate_geotiffs(image_files, index=None, align=False):
     """
-    Validate the GeoTIFFs and log any issues found.
+    Validate the GeoTIFFs and log any issues found. With a scene index, profiles are read from the index
+    and only new or changed files are opened. With align=True scenes on a different grid or CRS are kept,
+    since they will be warped onto a common grid, and only the band count has to match.
     """
     valid_images = []
     base_profile = None
@@ -28,70 +47,758 @@ def validate_geotiffs(image_files):
 
     for image_file in image_files:
         try:
-            with rasterio.open(image_file) as src:
-                profile = src.profile
-                if base_profile is None:
-                    base_profile = profile
-                else:
-                    if profile['transform'] != base_profile['transform']:
-                        log_entries.append(f"Alignment issue with {image_file}")
-                        continue
-                    if profile['crs'] != base_profile['crs']:
-                        log_entries.append(f"CRS mismatch with {image_file}")
-                        continue
-                valid_images.append(image_file)
+            if index is not None:
+                profile = index.get_scene(image_file)
+            else:
+                with rasterio.open(image_file) as src:
+                    profile = src.profile
+            if base_profile is None:
+                base_profile = profile
+            elif align:
+                if profile['count'] != base_profile['count']:
+                    log_entries.append(f"Band count mismatch with {image_file}")
+                    continue
+            else:
+                if profile['transform'] != base_profile['transform']:
+                    log_entries.append(f"Alignment issue with {image_file}")
+                    continue
+                if profile['crs'] != base_profile['crs']:
+                    log_entries.append(f"CRS mismatch with {image_file}")
+                    continue
+            valid_images.append(image_file)
         except RasterioIOError as e:
             log_entries.append(f"Rasterio error with {image_file}: {e}")
         except Exception as e:
             log_entries.append(f"Unknown error with {image_file}: {e}")
 
+    if index is not None:
+        index.commit()
     return valid_images, log_entries
 
 
-def compute_median_composite(image_files, output_file, log_file):
+def compute_target_grid(image_files, resolution=None, bounds=None, crs=None, index=None):
     """
-    Compute the median composite from a list of image files and save to output file.
+    Compute a common output grid for scenes that are not aligned. The grid covers the union of the scenes'
+    bounds, or the given AOI bounds (left, bottom, right, top) in the target CRS, snapped to multiples of the
+    resolution. The CRS and resolution default to the first scene's.
+    Returns a dict of crs (WKT), transform, width and height.
     """
-    # Read metadata of the first image to get the number of bands
-    with rasterio.open(image_files[0]) as src0:
-        meta = src0.meta
-        num_bands = src0.count
+    union = None
+    for image_file in image_files:
+        if index is not None:
+            scene = index.get_scene(image_file)
+            scene_crs, scene_transform, scene_bounds = scene['crs'], scene['transform'], scene['bounds']
+        else:
+            with rasterio.open(image_file) as src:
+                scene_crs, scene_transform, scene_bounds = src.crs, src.transform, src.bounds
+
+        if crs is None:
+            crs = scene_crs
+        if resolution is None:
+            resolution = (abs(scene_transform.a), abs(scene_transform.e))
+        if bounds is None:
+            scene_bounds = transform_bounds(scene_crs, crs, *scene_bounds)
+            if union is None:
+                union = scene_bounds
+            else:
+                union = (min(union[0], scene_bounds[0]), min(union[1], scene_bounds[1]),
+                         max(union[2], scene_bounds[2]), max(union[3], scene_bounds[3]))
+
+    if bounds is None:
+        bounds = union
+    if not isinstance(resolution, (tuple, list)):
+        resolution = (resolution, resolution)
+
+    x_res, y_res = resolution
+    left = math.floor(bounds[0] / x_res) * x_res
+    bottom = math.floor(bounds[1] / y_res) * y_res
+    right = math.ceil(bounds[2] / x_res) * x_res
+    top = math.ceil(bounds[3] / y_res) * y_res
+
+    return {
+        'crs': CRS.from_user_input(crs).to_wkt(),
+        'transform': from_origin(left, top, x_res, y_res),
+        'width': int(round((right - left) / x_res)),
+        'height': int(round((top - bottom) / y_res)),
+    }
+
+
+# Extra float32-sized copies of the (num_images, bands) stack each statistic makes while it runs. The order
+# statistics share one sorted copy, counted separately.
+STATISTIC_WORKING_COPIES = {
+    'median': 0,
+    'mean': 1,  # Stack with invalid values zeroed
+    'p10': 0,
+    'p90': 0,
+    'medoid': 2,  # Float32 differences from the median and their squares
+    'max_ndvi': 0,
+}
+
+# Statistics computed from the per-pixel sort
+SORTED_STATISTICS = ('median', 'p10', 'p90', 'medoid')
+
+
+def get_bytes_per_pixel(num_images, num_bands, statistics=('median',)):
+    """
+    Estimate the working memory per output pixel for computing the named statistics from one window.
+    """
+    stack_bytes = num_images * num_bands * np.dtype(np.float32).itemsize
+    # The tile itself and its valid mask
+    bytes_per_pixel = stack_bytes + num_images * num_bands
+    if any(name in SORTED_STATISTICS for name in statistics):
+        bytes_per_pixel += stack_bytes
+    bytes_per_pixel += sum(STATISTIC_WORKING_COPIES[name] for name in statistics) * stack_bytes
+    if 'max_ndvi' in statistics:
+        # Red, NIR, NDVI and a temporary, one value per image
+        bytes_per_pixel += 4 * num_images * np.dtype(np.float32).itemsize
+    # Each statistic's float32 output tile and the float64 intermediates it is computed from
+    bytes_per_pixel += len(statistics) * num_bands * (np.dtype(np.float32).itemsize + 3 * np.dtype(np.float64).itemsize)
+    return bytes_per_pixel
+
+
+def get_composite_windows(dst, num_images, num_bands, window_size=None, max_memory_mb=None,
+                          statistics=('median',)):
+    """
+    Return the output windows to composite, either the output's internal blocks or square tiles sized by
+    window_size or by a memory budget for computing the named statistics from a (num_images, bands, rows,
+    cols) tile. Budgeted tiles of a tiled output are rounded down to whole output tiles, at least one.
+    """
+    if max_memory_mb is not None:
+        bytes_per_pixel = get_bytes_per_pixel(num_images, num_bands, statistics)
+        window_size = max(1, int(math.sqrt(max_memory_mb * 1024 * 1024 / bytes_per_pixel)))
+        if dst.profile.get('tiled'):
+            # Whole output tiles, at least one, so compressed tiles are encoded once instead of being rewritten
+            # by every window that partly covers them
+            block_size = math.lcm(*dst.block_shapes[0])
+            window_size = max(block_size, window_size // block_size * block_size)
+
+    if window_size is None:
+        return [window for _, window in dst.block_windows(1)]
+
+    windows = []
+    for row_off in range(0, dst.height, window_size):
+        for col_off in range(0, dst.width, window_size):
+            windows.append(Window(col_off, row_off,
+                                  min(window_size, dst.width - col_off),
+                                  min(window_size, dst.height - row_off)))
+    return windows
+
+
+def read_window_stack(sources, window, num_bands):
+    """
+    Read a window from every source into a (num_images, bands, rows, cols) array in the sources' native
+    dtype, along with a boolean mask of valid (non-nodata, non-NaN) pixels. Dtypes that float32 can't hold
+    exactly are converted to float32 so results match a float32 composite.
+    Returns the array, the mask, the image files read (in stack order) and a list of log entries for any
+    sources that failed to read.
+    """
+    tiles = []
+    masks = []
+    read_files = []
+    log_entries = []
+    for image_file, src in sources.items():
+        try:
+            tile = src.read(list(range(1, num_bands + 1)), window=window)
+            if not np.can_cast(tile.dtype, np.float32, casting='safe'):
+                tile = tile.astype(np.float32)
+            valid = tile != src.nodata if src.nodata is not None else np.ones(tile.shape, dtype=bool)
+            if np.issubdtype(tile.dtype, np.floating):
+                valid &= ~np.isnan(tile)
+            tiles.append(tile)
+            masks.append(valid)
+            read_files.append(image_file)
+        except Exception as e:
+            log_entries.append(f"Error reading {image_file} at {window}: {e}")
+
+    return np.stack(tiles, axis=0), np.stack(masks, axis=0), read_files, log_entries
+
+
+def sort_pixels(stack, valid):
+    """
+    Sort each pixel's values across the first axis of a stack, as one contiguous (pixels, images) row per
+    pixel with invalid values filled so they sort to the end. Returns the sorted rows and per-pixel counts of
+    valid values.
+    """
+    num_images = stack.shape[0]
+    valid = valid.reshape(num_images, -1)
+
+    pixels = np.ascontiguousarray(stack.reshape(num_images, -1).T)
+    if np.issubdtype(pixels.dtype, np.floating):
+        pixels[~valid.T] = np.nan
+    else:
+        pixels[~valid.T] = np.iinfo(pixels.dtype).max
+    pixels.sort(axis=1)
+
+    return pixels, valid.sum(axis=0)
+
+
+def take_sorted(pixels, positions):
+    """
+    Take the value at a per-pixel position from sorted pixel rows.
+    """
+    positions = np.clip(positions, 0, pixels.shape[1] - 1)
+    return np.take_along_axis(pixels, positions[:, np.newaxis], axis=1)[:, 0]
+
+
+def sorted_median(pixels, counts):
+    """
+    Compute the median of sorted pixel rows from their valid counts, NaN where there are none.
+    """
+    # The median lies between the two middle valid values of each row
+    lower = take_sorted(pixels, (counts - 1) // 2)
+    upper = take_sorted(pixels, counts // 2)
+    median = ((lower.astype(np.float64) + upper) / 2).astype(np.float32)
+    median[counts == 0] = np.nan
+    return median
+
+
+def nanmedian(stack, valid):
+    """
+    Compute the median of the valid values along the first axis of a stack in its native dtype.
+
+    Matches np.nanmedian of the stack converted to float32 with invalid values set to NaN, but sorts each
+    pixel's values as a contiguous row instead, avoiding the float conversion and masked array overhead.
+    Pixels with no valid values are NaN.
+    """
+    pixels, counts = sort_pixels(stack, valid)
+    return sorted_median(pixels, counts).reshape(stack.shape[1:])
+
+
+class ImageStack:
+    """
+    A window read from every image, passed to the composite statistics. The per-pixel sort is computed once
+    and shared by the order statistics (median, percentiles).
+    """
+
+    def __init__(self, stack, valid):
+        self.stack = stack
+        self.valid = valid
+
+    @cached_property
+    def sorted_pixels(self):
+        return sort_pixels(self.stack, self.valid)
+
+    @property
+    def out_shape(self):
+        return self.stack.shape[1:]
+
+
+def composite_median(images):
+    """
+    Per-pixel median of the valid values.
+    """
+    pixels, counts = images.sorted_pixels
+    return sorted_median(pixels, counts).reshape(images.out_shape)
+
+
+def composite_percentile(images, q):
+    """
+    Per-pixel q-th percentile of the valid values, using linear interpolation like np.nanpercentile.
+    """
+    pixels, counts = images.sorted_pixels
+    position = q / 100 * np.maximum(counts - 1, 0)
+    lower_position = np.floor(position).astype(np.intp)
+    fraction = position - lower_position
+    lower = take_sorted(pixels, lower_position).astype(np.float64)
+    upper = take_sorted(pixels, lower_position + 1).astype(np.float64)
+    # Rows with a single valid value have no upper neighbour, but their fraction is zero
+    percentile = np.where(fraction > 0, lower + (upper - lower) * fraction, lower).astype(np.float32)
+    percentile[counts == 0] = np.nan
+    return percentile.reshape(images.out_shape)
+
+
+def composite_mean(images):
+    """
+    Per-pixel mean of the valid values.
+    """
+    counts = images.valid.sum(axis=0)
+    totals = np.where(images.valid, images.stack, 0).sum(axis=0, dtype=np.float64)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        mean = (totals / counts).astype(np.float32)
+    mean[counts == 0] = np.nan
+    return mean
+
+
+def select_images(images, index, selected):
+    """
+    Take every band from the image chosen for each pixel, NaN where no image was selected or the chosen
+    image has no valid value for a band.
+    """
+    index = index[np.newaxis, np.newaxis]
+    composite = np.take_along_axis(images.stack, index, axis=0)[0].astype(np.float32)
+    composite[~np.take_along_axis(images.valid, index, axis=0)[0]] = np.nan
+    composite[:, ~selected] = np.nan
+    return composite
+
+
+def composite_medoid(images):
+    """
+    Per-pixel observation closest (Euclidean distance across bands) to the per-band median, taken from
+    images valid in every band.
+    """
+    median = composite_median(images)
+    usable = images.valid.all(axis=1)
+    distance = np.square(images.stack.astype(np.float32) - median[np.newaxis]).sum(axis=1)
+    distance[~usable] = np.inf
+    return select_images(images, np.argmin(distance, axis=0), usable.any(axis=0))
+
+
+def composite_max_ndvi(images, red_band, nir_band):
+    """
+    Per-pixel observation with the highest NDVI. Bands are numbered from 1.
+    """
+    red = images.stack[:, red_band - 1].astype(np.float32)
+    nir = images.stack[:, nir_band - 1].astype(np.float32)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        ndvi = (nir - red) / (nir + red)
+    usable = images.valid[:, red_band - 1] & images.valid[:, nir_band - 1] & np.isfinite(ndvi)
+    ndvi[~usable] = -np.inf
+    return select_images(images, np.argmax(ndvi, axis=0), usable.any(axis=0))
+
+
+# Composite statistics by name, each computed from an ImageStack into a (bands, rows, cols) float32 array
+COMPOSITE_STATISTICS = {
+    'median': composite_median,
+    'mean': composite_mean,
+    'p10': partial(composite_percentile, q=10),
+    'p90': partial(composite_percentile, q=90),
+    'medoid': composite_medoid,
+    'max_ndvi': partial(composite_max_ndvi, red_band=3, nir_band=7),  # ARCSI Sentinel-2 band order
+}
+
+
+def window_footprints(valid, read_files, window):
+    """
+    Find the pixel bounds (row_start, col_start, row_stop, col_stop) of each image's valid data within a
+    window, in output pixel coordinates. Images with no valid data in the window are left out.
+    """
+    footprints = {}
+    for image_file, image_valid in zip(read_files, valid.any(axis=1)):
+        rows = np.flatnonzero(image_valid.any(axis=1))
+        cols = np.flatnonzero(image_valid.any(axis=0))
+        if rows.size:
+            footprints[image_file] = (int(window.row_off + rows[0]), int(window.col_off + cols[0]),
+                                      int(window.row_off + rows[-1] + 1), int(window.col_off + cols[-1] + 1))
+    return footprints
+
+
+def merge_footprints(footprints, new_footprints):
+    """
+    Grow each image's footprint to include its footprint in another window.
+    """
+    for image_file, (row_start, col_start, row_stop, col_stop) in new_footprints.items():
+        if image_file in footprints:
+            old = footprints[image_file]
+            footprints[image_file] = (min(old[0], row_start), min(old[1], col_start),
+                                      max(old[2], row_stop), max(old[3], col_stop))
+        else:
+            footprints[image_file] = (row_start, col_start, row_stop, col_stop)
+    return footprints
+
+
+def compute_window_statistics(sources, window, num_bands, statistics):
+    """
+    Compute every requested composite statistic for a single output window from one read of the sources.
+    Also returns the footprint of each image's valid data in the window.
+    """
+    tile_stack, valid, read_files, log_entries = read_window_stack(sources, window, num_bands)
+    images = ImageStack(tile_stack, valid)
+    tiles = {name: reducer(images) for name, reducer in statistics.items()}
+    return tiles, window_footprints(valid, read_files, window), log_entries
+
 
-    # Read all images and stack into a list of numpy arrays
-    stacks = []
+def get_statistics(statistics, num_bands=None):
+    """
+    Look up composite statistics by name, checking against num_bands, if given, that the images have the
+    bands they need.
+    """
+    statistics = {name: COMPOSITE_STATISTICS[name] for name in statistics}
+    if num_bands is not None and 'max_ndvi' in statistics:
+        red_band = statistics['max_ndvi'].keywords['red_band']
+        nir_band = statistics['max_ndvi'].keywords['nir_band']
+        if max(red_band, nir_band) > num_bands:
+            raise ValueError(f"max_ndvi needs bands {red_band} and {nir_band}, but the images have {num_bands}")
+    return statistics
+
+
+def open_sources(stack, image_files, grid=None):
+    """
+    Open every image file on the given ExitStack, returning the datasets (keyed by image file) and log
+    entries for failures.
+    With a target grid, scenes not already on it are wrapped in a WarpedVRT so each window is reprojected
+    on the fly as it is read.
+    """
+    sources = {}
+    log_entries = []
     for image_file in image_files:
         try:
-            with rasterio.open(image_file) as src:
-                bands = []
-                for band in range(1, num_bands + 1):
-                    band_data = src.read(band).astype(np.float32)
-                    band_data[band_data == src.nodata] = np.nan  # Mask out nodata values
-                    bands.append(band_data)
-                stacks.append(np.stack(bands, axis=0))
+            src = stack.enter_context(rasterio.open(image_file))
+            if grid is not None and not on_grid(src, grid):
+                # Pixels outside the scene need a nodata value to be excluded from the composite
+                src = stack.enter_context(WarpedVRT(src, crs=grid['crs'], transform=grid['transform'],
+                                                    width=grid['width'], height=grid['height'],
+                                                    nodata=src.nodata if src.nodata is not None else 0,
+                                                    resampling=Resampling.nearest))
+            sources[image_file] = src
         except Exception as e:
-            with open(log_file, 'a') as log:
-                log.write(f"Error reading {image_file}: {e}\n")
+            log_entries.append(f"Error reading {image_file}: {e}")
+    return sources, log_entries
+
+
+def on_grid(src, grid):
+    """
+    Check whether a dataset is already on the target grid.
+    """
+    return (src.crs == CRS.from_wkt(grid['crs']) and src.transform == grid['transform']
+            and src.width == grid['width'] and src.height == grid['height'])
+
 
-    # Stack into a 4D array (bands, rows, cols, num_images)
-    stacks = np.stack(stacks, axis=-1)
+def write_log_entries(log_file, log_entries):
+    """
+    Append log entries to a log file.
+    """
+    if log_entries:
+        with open(log_file, 'a') as log:
+            for entry in log_entries:
+                log.write(entry + "\n")
 
-    # Compute the median along the fourth axis, ignoring NaNs
-    with warnings.catch_warnings():
-        warnings.filterwarnings(action='ignore', message='All-NaN slice encountered')
-        median_image = np.nanmedian(stacks, axis=-1)
+
+def get_composite_meta(image_files, grid=None):
+    """
+    Get the output metadata and band count for a composite from the first image, placed on the target grid
+    if one is given.
+    """
+    # Read metadata of the first image to get the number of bands
+    with rasterio.open(image_files[0]) as src0:
+        meta = src0.meta
+        num_bands = src0.count
 
     # Update metadata to reflect the number of layers
     meta.update(count=num_bands, dtype=rasterio.float32)
+    if grid is not None:
+        meta.update(crs=CRS.from_wkt(grid['crs']), transform=grid['transform'], width=grid['width'],
+                    height=grid['height'])
+        if meta['nodata'] is None:
+            meta['nodata'] = 0
+    return meta, num_bands
+
+
+# Datasets opened by a worker process, kept open between windows of the same year
+_worker_sources = {}
+
+
+def _worker_open_sources(image_files, grid=None):
+    """
+    Open (or reuse) this worker process's own rasterio handles on a year's images.
+    """
+    key = tuple(image_files)
+    if key not in _worker_sources:
+        for stack, _, _ in _worker_sources.values():
+            stack.close()
+        _worker_sources.clear()
+        stack = ExitStack()
+        sources, log_entries = open_sources(stack, image_files, grid)
+        _worker_sources[key] = (stack, sources, log_entries)
+        return sources, log_entries
+    return _worker_sources[key][1], []
+
+
+def _composite_window_task(image_files, window, num_bands, statistics, grid=None):
+    """
+    Worker task computing one output window; the results are written by the parent process.
+    """
+    sources, log_entries = _worker_open_sources(image_files, grid)
+    tiles, footprints, read_log_entries = compute_window_statistics(sources, window, num_bands, statistics)
+    return tiles, footprints, log_entries + read_log_entries
+
+
+def open_outputs(stack, output_files, meta, update=False):
+    """
+    Open the output file for each statistic on the given ExitStack, creating them or, with update=True,
+    opening the existing outputs to rewrite some of their windows.
+    """
+    if update:
+        return {name: stack.enter_context(rasterio.open(output_file, 'r+'))
+                for name, output_file in output_files.items()}
+    return {name: stack.enter_context(rasterio.open(output_file, 'w', **meta))
+            for name, output_file in output_files.items()}
+
+
+def plan_windows(dst, num_images, num_bands, streaming=False, window_size=None, max_memory_mb=None, dirty=None,
+                 statistics=('median',)):
+    """
+    List the output windows to compute for the named statistics. Without streaming the whole output is a
+    single window. With a list of dirty footprints only the windows intersecting them are returned.
+    """
+    if streaming:
+        windows = get_composite_windows(dst, num_images, num_bands, window_size, max_memory_mb, statistics)
+    else:
+        windows = [Window(0, 0, dst.width, dst.height)]
+
+    if dirty is not None:
+        windows = [window for window in windows if any(intersects(window, footprint) for footprint in dirty)]
+    return windows
+
+
+def compute_composites_parallel(jobs, executor, streaming=False, window_size=None, max_memory_mb=None,
+                                output_profile='default', max_in_flight=2):
+    """
+    Compute composites for a list of (image_files, output_files, log_file, grid, dirty) jobs on a process
+    pool, where output_files maps each statistic name to its output file, grid is a target grid or None and
+    dirty is None to create the outputs or a list of footprints to recompute in existing outputs.
+
+    The output windows of every job are submitted to the pool, with at most max_in_flight (about twice the
+    number of workers) pending at once so finished tiles never pile up in this process. Workers open their
+    own rasterio handles. This process is the single writer, writing each window once as it completes and
+    then dropping its result, so the composites are identical to the serial path. Without streaming each job
+    is a single full-extent window. Outputs are written with the given output_profile (see
+    output_profile.OUTPUT_PROFILES).
+    Returns the footprints of each image's valid data, one dict per job.
+    """
+    footprints = [{} for _ in jobs]
+    with ExitStack() as stack:
+        tasks = []
+        for job_index, (image_files, output_files, log_file, grid, dirty) in enumerate(jobs):
+            meta, num_bands = get_composite_meta(image_files, grid)
+            statistics = get_statistics(output_files, num_bands)
+            dsts = open_outputs(stack, output_files, get_output_meta(meta, output_profile), update=dirty is not None)
+            windows = plan_windows(next(iter(dsts.values())), len(image_files), num_bands, streaming,
+                                   window_size, max_memory_mb, dirty, statistics)
+            for window in windows:
+                tasks.append(((image_files, window, num_bands, statistics, grid), (dsts, window, log_file, job_index)))
+
+        logged = set()
+        futures = {}
+        pending = iter(tasks)
+        with tqdm(total=len(tasks), desc="Compositing windows") as progress:
+            while True:
+                # Top up the pool, then write whichever window finishes first
+                for args, context in pending:
+                    futures[executor.submit(_composite_window_task, *args)] = context
+                    if len(futures) >= max_in_flight:
+                        break
+                if not futures:
+                    break
+
+                future = next(as_completed(futures))
+                dsts, window, log_file, job_index = futures.pop(future)
+                tiles, window_footprints, log_entries = future.result()
+                # Workers each report an unreadable file once, so only log new entries
+                new_entries = [entry for entry in log_entries if (log_file, entry) not in logged]
+                logged.update((log_file, entry) for entry in new_entries)
+                write_log_entries(log_file, new_entries)
+                merge_footprints(footprints[job_index], window_footprints)
+                for name, tile in tiles.items():
+                    dsts[name].write(tile, window=window)
+                progress.update()
+
+    for job in jobs:
+        for output_file in job[1].values():
+            finalize_output(output_file, output_profile)
+    return footprints
+
+
+def compute_composite(image_files, output_files, log_file, streaming=False, window_size=None,
+                      max_memory_mb=None, workers=1, grid=None, dirty=None, output_profile='default'):
+    """
+    Compute composites from a list of image files in a single read of the inputs. output_files maps each
+    statistic name in COMPOSITE_STATISTICS to the output file it is saved to.
 
-    # Write the median composite to a new file
-    with rasterio.open(output_file, 'w', **meta) as dst:
-        for band in range(num_bands):
-            dst.write(median_image[band], band + 1)
+    With streaming=True the composites are built one output window at a time, so peak memory is bounded by
+    window size x number of images rather than the full scene x number of images. Windows default to the
+    output's internal blocks, or can be set with window_size (pixels) or max_memory_mb. With workers > 1
+    the windows are computed on a process pool. With a target grid (see compute_target_grid) scenes are
+    warped onto it window by window, without writing reprojected copies to disk. With a list of dirty
+    footprints only the windows intersecting them are recomputed in the existing outputs. Outputs are
+    written with the given output_profile (see output_profile.OUTPUT_PROFILES).
+    Returns the footprint of each image's valid data.
+    """
+    if workers > 1:
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            return compute_composites_parallel([(image_files, output_files, log_file, grid, dirty)], executor,
+                                               streaming, window_size, max_memory_mb, output_profile,
+                                               max_in_flight=2 * workers)[0]
+
+    meta, num_bands = get_composite_meta(image_files, grid)
+    statistics = get_statistics(output_files, num_bands)
+    footprints = {}
+
+    with ExitStack() as stack:
+        # Open every image once and read only the current window from each
+        sources, log_entries = open_sources(stack, image_files, grid)
+        write_log_entries(log_file, log_entries)
+
+        # Write each composite to a new file
+        dsts = open_outputs(stack, output_files, get_output_meta(meta, output_profile), update=dirty is not None)
+        windows = plan_windows(next(iter(dsts.values())), len(sources), num_bands, streaming, window_size,
+                               max_memory_mb, dirty, statistics)
+
+        for window in windows:
+            tiles, window_footprints, log_entries = compute_window_statistics(sources, window, num_bands,
+                                                                              statistics)
+            write_log_entries(log_file, log_entries)
+            merge_footprints(footprints, window_footprints)
+            for name, tile in tiles.items():
+                dsts[name].write(tile, window=window)
+
+    for output_file in output_files.values():
+        finalize_output(output_file, output_profile)
+    return footprints
+
+
+def compute_median_composite(image_files, output_file, log_file, streaming=False, window_size=None,
+                             max_memory_mb=None, workers=1, output_profile='default'):
+    """
+    Compute the median composite from a list of image files and save to output file.
+    """
+    compute_composite(image_files, {'median': output_file}, log_file, streaming, window_size, max_memory_mb,
+                      workers, output_profile=output_profile)
+
+
+def intersects(window, footprint):
+    """
+    Check whether a window overlaps a footprint (row_start, col_start, row_stop, col_stop).
+    """
+    row_start, col_start, row_stop, col_stop = footprint
+    return (window.row_off < row_stop and window.row_off + window.height > row_start
+            and window.col_off < col_stop and window.col_off + window.width > col_start)
+
+
+def describe_grid(meta):
+    """
+    Describe an output grid so a recorded composite can be checked against the current inputs.
+    """
+    return {
+        'crs': meta['crs'].to_wkt() if meta['crs'] else None,
+        'transform': list(meta['transform'])[:6],
+        'width': meta['width'],
+        'height': meta['height'],
+        'count': meta['count'],
+    }
+
+
+def scene_footprints(image_files, num_bands, grid=None, window_size=1024):
+    """
+    Read only the given scenes to find the footprint of their valid data on the output grid.
+    """
+    footprints = {}
+    with ExitStack() as stack:
+        sources, _ = open_sources(stack, image_files, grid)
+        for image_file, src in sources.items():
+            for row_off in range(0, src.height, window_size):
+                for col_off in range(0, src.width, window_size):
+                    window = Window(col_off, row_off, min(window_size, src.width - col_off),
+                                    min(window_size, src.height - row_off))
+                    _, valid, read_files, _ = read_window_stack({image_file: src}, window, num_bands)
+                    merge_footprints(footprints, window_footprints(valid, read_files, window))
+    return footprints
+
+
+def plan_update(image_files, output_files, manifest_file, grid=None):
+    """
+    Compare the inputs of a composite with those recorded in its manifest.
 
+    Returns (dirty, footprints): dirty is None if the composite has to be built from scratch (no manifest,
+    missing outputs, or a different grid or statistics), otherwise the footprints of new, changed and removed
+    scenes, empty if the composite is up to date. footprints holds the current footprint of every scene
+    known so far.
+    """
+    if not os.path.exists(manifest_file) or not all(os.path.exists(f) for f in output_files.values()):
+        return None, {}
+    with open(manifest_file) as f:
+        manifest = json.load(f)
+
+    meta, num_bands = get_composite_meta(image_files, grid)
+    if manifest['grid'] != describe_grid(meta) or manifest['statistics'] != list(output_files):
+        return None, {}
+
+    recorded = manifest['scenes']
+    changed = [image_file for image_file in image_files
+               if image_file not in recorded or recorded[image_file]['signature'] != file_signature(image_file)]
+    removed = [image_file for image_file in recorded if image_file not in image_files]
+
+    footprints = {image_file: tuple(recorded[image_file]['footprint']) for image_file in image_files
+                  if image_file not in changed and recorded[image_file]['footprint'] is not None}
+    new_footprints = scene_footprints(changed, num_bands, grid)
+    footprints.update(new_footprints)
+
+    # Windows covered by a scene's old or new data need recomputing
+    dirty = list(new_footprints.values())
+    dirty += [tuple(recorded[image_file]['footprint']) for image_file in changed + removed
+              if image_file in recorded and recorded[image_file]['footprint'] is not None]
+    return dirty, footprints
+
+
+def save_manifest(manifest_file, image_files, output_files, footprints, grid=None):
+    """
+    Record the inputs of a composite, with the footprint of each scene's valid data, for incremental updates.
+    """
+    meta, _ = get_composite_meta(image_files, grid)
+    manifest = {
+        'grid': describe_grid(meta),
+        'statistics': list(output_files),
+        'scenes': {image_file: {'signature': file_signature(image_file),
+                                'footprint': list(footprints[image_file]) if image_file in footprints else None}
+                   for image_file in image_files},
+    }
+    with open(manifest_file, 'w') as f:
+        json.dump(manifest, f, indent=2)
+
+
+def prepare_year(year_folder, composite_dir, file_suffix, log_dir, statistics=('median',), index_path=None,
+                 align=False, resolution=None, aoi_bounds=None, dst_crs=None):
+    """
+    Find and validate the images for a year folder, writing any validation issues to the year's log file.
+    With align=True misaligned scenes are kept and a target grid is computed for them.
+    Returns (image_files, output_files, log_file, grid, manifest_file), or None if there is nothing to
+    composite.
+    """
+    year = os.path.basename(year_folder)
+    grid = None
+    with ExitStack() as stack:
+        index = stack.enter_context(SceneIndex(index_path)) if index_path is not None else None
+        image_files = get_image_files(year_folder, file_suffix, index)
+        valid_images, log_entries = validate_geotiffs(image_files, index, align)
+        if align and valid_images:
+            grid = compute_target_grid(valid_images, resolution, aoi_bounds, dst_crs, index)
 
-def create_median_composites(input_dir, composite_dir, file_suffix, log_dir):
+    if not image_files:
+        print(f"No images found for year {year} with suffix {file_suffix}")
+        return None
+
+    log_file = os.path.join(log_dir, f"{year}_log.txt")
+    if log_entries:
+        with open(log_file, 'w') as log:
+            for entry in log_entries:
+                log.write(entry + "\n")
+
+    if not valid_images:
+        print(f"No valid images found for year {year} after validation. See log file: {log_file}")
+        return None
+
+    output_files = {name: os.path.join(composite_dir, f"{year}_{name}_composite.tif") for name in statistics}
+    manifest_file = os.path.join(composite_dir, f"{year}_composite_inputs.json")
+    return valid_images, output_files, log_file, grid, manifest_file
+
+
+def create_median_composites(input_dir, composite_dir, file_suffix, log_dir, streaming=False, window_size=None,
+                             max_memory_mb=None, workers=1, statistics=('median',), index_path=None,
+                             align=False, resolution=None, aoi_bounds=None, dst_crs=None, incremental=False,
+                             output_profile='default'):
     """
-    Create median composites for each year in the output directory.
+    Create composites for each year in the output directory, one output file per statistic
+    (e.g. 2023_median_composite.tif, 2023_p90_composite.tif), all computed from a single read of each year.
+
+    With workers > 1 the years are validated in parallel and the windows of every year are composited on a
+    shared process pool. With index_path, image discovery and validation use a SceneIndex database at that
+    path instead of walking the tree and opening every file. With align=True scenes that are not on the
+    first scene's grid are warped onto a common grid (the union of the scenes or aoi_bounds, at resolution
+    and dst_crs) instead of being dropped.
+
+    Each year's inputs are recorded in {year}_composite_inputs.json. With incremental=True only the windows
+    overlapping new, changed or removed scenes are recomputed (streaming=True gives the finest windows), and
+    years with unchanged inputs are skipped. Outputs are written with the given output_profile (see
+    output_profile.OUTPUT_PROFILES).
     """
     if not os.path.exists(composite_dir):
         os.makedirs(composite_dir)
@@ -101,26 +808,47 @@ def create_median_composites(input_dir, composite_dir, file_suffix, log_dir):
     year_folders = [os.path.join(input_dir, d) for d in os.listdir(input_dir) if
                     os.path.isdir(os.path.join(input_dir, d))]
 
-    for year_folder in tqdm(year_folders, desc="Creating composites"):
-        year = os.path.basename(year_folder)
-        image_files = get_image_files(year_folder, file_suffix)
-
-        if image_files:
-            log_file = os.path.join(log_dir, f"{year}_log.txt")
-            valid_images, log_entries = validate_geotiffs(image_files)
-            if log_entries:
-                with open(log_file, 'w') as log:
-                    for entry in log_entries:
-                        log.write(entry + "\n")
-
-            if valid_images:
-                output_file = os.path.join(composite_dir, f"{year}_median_composite.tif")
-                compute_median_composite(valid_images, output_file, log_file)
-                # print(f"Created median composite for year {year}: {output_file}")
-            else:
-                print(f"No valid images found for year {year} after validation. See log file: {log_file}")
+    prepare = partial(prepare_year, composite_dir=composite_dir, file_suffix=file_suffix, log_dir=log_dir,
+                      statistics=statistics, index_path=index_path, align=align, resolution=resolution,
+                      aoi_bounds=aoi_bounds, dst_crs=dst_crs)
+
+    with ExitStack() as stack:
+        executor = stack.enter_context(ProcessPoolExecutor(max_workers=workers)) if workers > 1 else None
+        if executor is not None:
+            prepared = [job for job in executor.map(prepare, year_folders) if job is not None]
+        else:
+            prepared = [job for job in map(prepare, year_folders) if job is not None]
+
+        jobs = []
+        manifests = []
+        for valid_images, output_files, log_file, grid, manifest_file in prepared:
+            dirty, footprints = None, {}
+            if incremental:
+                dirty, footprints = plan_update(valid_images, output_files, manifest_file, grid)
+                if dirty == []:
+                    print(f"No new or changed images, skipping composites recorded in {manifest_file}")
+                    continue
+            if dirty is None and os.path.exists(manifest_file):
+                # A full build rewrites the outputs from scratch, so drop the old manifest first: if the build
+                # fails part way, the next incremental run must not trust the half-written outputs
+                os.remove(manifest_file)
+            jobs.append((valid_images, output_files, log_file, grid, dirty))
+            manifests.append((manifest_file, footprints))
+
+        if executor is not None:
+            results = compute_composites_parallel(jobs, executor, streaming, window_size, max_memory_mb,
+                                                  output_profile, max_in_flight=2 * workers)
         else:
-            print(f"No images found for year {year} with suffix {file_suffix}")
+            results = []
+            for valid_images, output_files, log_file, grid, dirty in tqdm(jobs, desc="Creating composites"):
+                results.append(compute_composite(valid_images, output_files, log_file, streaming, window_size,
+                                                 max_memory_mb, grid=grid, dirty=dirty,
+                                                 output_profile=output_profile))
+
+    for job, (manifest_file, footprints), computed in zip(jobs, manifests, results):
+        valid_images, output_files, _, grid, dirty = job
+        # A full build sees every scene's footprint, an update keeps the footprints planned for it
+        save_manifest(manifest_file, valid_images, output_files, computed if dirty is None else footprints, grid)
 
 
 # Parameters
@@ -128,6 +856,17 @@ output_directory = r"C:\Users\powelj\Documents\Aotea_test_files\Sentinel\Outputs
 composite_directory = r"C:\Users\powelj\Documents\Aotea_test_files\Sentinel\Composites"
 log_directory = r"C:\Users\powelj\Documents\Aotea_test_files\Sentinel\Log\composite"
 masked_tif = "_mclds_topshad_rad_srefdem_stdsref.tif"
+streaming = True  # Composite window by window to bound memory use
+max_memory_mb = 1024  # Memory budget for each window's image stack
+workers = 1  # Number of processes compositing windows in parallel
+statistics = ['median']  # Any of COMPOSITE_STATISTICS, e.g. ['median', 'p10', 'p90', 'max_ndvi']
+index_path = r"C:\Users\powelj\Documents\Aotea_test_files\Sentinel\scene_index.sqlite"
+align = False  # Warp misaligned scenes onto a common grid instead of dropping them
+incremental = True  # Only recompute windows affected by new, changed or removed scenes
+output_profile = "tiled"  # One of output_profile.OUTPUT_PROFILES: default, tiled, zstd, lzw or cog
 
 if __name__ == "__main__":
-    create_median_composites(output_directory, composite_directory, masked_tif, log_directory)
+    create_median_composites(output_directory, composite_directory, masked_tif, log_directory, streaming,
+                             max_memory_mb=max_memory_mb, workers=workers, statistics=statistics,
+                             index_path=index_path, align=align, incremental=incremental,
+                             output_profile=output_profile)
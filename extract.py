@@ -1,9 +1,63 @@
 import os
+import re
+import json
 import shutil
+from concurrent.futures import ThreadPoolExecutor
 from tqdm import tqdm
+from file_utils import hardlink_file
 
-# Function to extract sentinel data (.SAFE files) from RAW directory
-def extract_sentinel_data(input_dir, output_dir):
+# Manifest of SAFE products registered in place (mode='manifest'), mapping product name to its RAW path
+MANIFEST_NAME = "safe_manifest.json"
+
+# FICLONE ioctl request, clones a file's extents on copy-on-write filesystems (Btrfs, XFS)
+FICLONE = 0x40049409
+
+# Band name of a granule image, e.g. T60HUE_20231224T222549_B02.jp2 or ..._B8A_20m.jp2 (L2A)
+BAND_PATTERN = re.compile(r'_(B\d{2}|B8A|TCI)(_\d+m)?\.jp2$')
+
+
+# Function to copy a file as a copy-on-write clone where the filesystem supports it, else a normal copy
+def reflink_file(src, dst):
+    try:
+        import fcntl
+        with open(src, 'rb') as src_file, open(dst, 'wb') as dst_file:
+            fcntl.ioctl(dst_file.fileno(), FICLONE, src_file.fileno())
+        shutil.copystat(src, dst)
+    except (ImportError, OSError):
+        shutil.copy2(src, dst)
+
+
+FILE_OPERATIONS = {
+    'copy': shutil.copy2,
+    'hardlink': hardlink_file,
+    'reflink': reflink_file,
+}
+
+
+# Function to check whether a file in a SAFE product is needed. With a band list, JP2s in IMG_DATA are only
+# kept for those bands; every other file (metadata, QI data) is always kept.
+def is_selected(relative_path, bands=None):
+    if bands is None or 'IMG_DATA' not in relative_path.split(os.sep):
+        return True
+    match = BAND_PATTERN.search(relative_path)
+    return match is None or match.group(1) in bands
+
+
+# Function to read the SAFE products registered with mode='manifest'
+def read_safe_manifest(output_dir):
+    with open(os.path.join(output_dir, MANIFEST_NAME)) as f:
+        return json.load(f)
+
+
+# Function to extract sentinel data (.SAFE files) from RAW directory. mode is one of:
+#   'copy'     - copy every file (the original behaviour)
+#   'hardlink' - hardlink files, no extra disk use when RAW and temp share a filesystem
+#   'reflink'  - copy-on-write clones where the filesystem supports them
+#   'symlink'  - link each .SAFE folder in place
+#   'manifest' - copy nothing and record the .SAFE paths in safe_manifest.json for reading in place
+# bands (e.g. ['B02', 'B03', 'B04', 'B08']) limits the IMG_DATA JP2s extracted, and workers sets the number
+# of threads used for copying.
+def extract_sentinel_data(input_dir, output_dir, mode='copy', bands=None, workers=1):
     # Check for and create temp directory
     if not os.path.exists(output_dir):
         os.makedirs(output_dir)
@@ -16,17 +70,53 @@ def extract_sentinel_data(input_dir, output_dir):
             if dir_name.endswith('.SAFE'):
                 safe_files.append((root, dir_name))
 
-    # Copy .SAFE folders from RAW to temp
-    for root, dir_name in tqdm(safe_files, desc="Extracting RAW data"):
-        safe_folder_path = os.path.join(root, dir_name)
-        dest_folder_path = os.path.join(output_dir, dir_name)
-        if not os.path.exists(dest_folder_path):
-            shutil.copytree(safe_folder_path, dest_folder_path)
+    # Register .SAFE folders in place
+    if mode == 'manifest':
+        manifest = {dir_name: os.path.abspath(os.path.join(root, dir_name)) for root, dir_name in safe_files}
+        with open(os.path.join(output_dir, MANIFEST_NAME), 'w') as f:
+            json.dump(manifest, f, indent=2)
+        print(f"Registered {len(manifest)} SAFE products in {os.path.join(output_dir, MANIFEST_NAME)}")
+        return
+
+    if mode != 'symlink' and mode not in FILE_OPERATIONS:
+        raise ValueError(f"Unknown extraction mode: {mode}")
+
+    # Link or copy .SAFE folders from RAW to temp
+    file_operation = FILE_OPERATIONS.get(mode)
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        for root, dir_name in tqdm(safe_files, desc="Extracting RAW data"):
+            safe_folder_path = os.path.join(root, dir_name)
+            dest_folder_path = os.path.join(output_dir, dir_name)
+            if os.path.exists(dest_folder_path):
+                continue
+
+            if mode == 'symlink':
+                os.symlink(os.path.abspath(safe_folder_path), dest_folder_path, target_is_directory=True)
+                tqdm.write(f"Linked {safe_folder_path} to {dest_folder_path}")
+                continue
+
+            # Build into a partial folder so an interrupted copy isn't mistaken for a complete one
+            partial_folder_path = dest_folder_path + '.partial'
+            if os.path.exists(partial_folder_path):
+                shutil.rmtree(partial_folder_path)
+            jobs = []
+            for src_root, _, files in os.walk(safe_folder_path):
+                dst_root = os.path.join(partial_folder_path, os.path.relpath(src_root, safe_folder_path))
+                os.makedirs(dst_root, exist_ok=True)
+                for file in files:
+                    src_path = os.path.join(src_root, file)
+                    if is_selected(os.path.relpath(src_path, safe_folder_path), bands):
+                        jobs.append(executor.submit(file_operation, src_path, os.path.join(dst_root, file)))
+            for job in jobs:
+                job.result()
+            os.replace(partial_folder_path, dest_folder_path)
             tqdm.write(f"Copied {safe_folder_path} to {dest_folder_path}")
 
 
 if __name__ == "__main__":
     raw_directory = "sentinel/RAW"
     temp_directory = "sentinel/tmp"
+    mode = 'hardlink'
+    workers = 4
 
-    extract_sentinel_data(raw_directory, temp_directory)
+    extract_sentinel_data(raw_directory, temp_directory, mode, workers=workers)
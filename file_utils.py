@@ -0,0 +1,20 @@
+import os
+import shutil
+
+
+def file_signature(path):
+    """
+    Identify a version of a file by its modification time and size.
+    """
+    stat = os.stat(path)
+    return [stat.st_mtime, stat.st_size]
+
+
+def hardlink_file(src, dst):
+    """
+    Hardlink src to dst, copying it instead if the two are on different filesystems.
+    """
+    try:
+        os.link(src, dst)
+    except OSError:
+        shutil.copy2(src, dst)
@@ -1,10 +1,18 @@
 import os
-import rasterio
-from rasterio.merge import merge
-from rasterio.enums import Resampling
+from vrt_stack import build_stack_vrt, materialize_vrt
 
 
-def stack_layers(input_dir, output_dir):
+def stack_layers(input_dir, output_dir, output_profile='default', mode='tiff'):
+    """
+    Stack the .TIF bands in each folder below input_dir into one multi-band raster per folder.
+
+    mode='tiff' writes a GeoTIFF, streamed window by window from a virtual stack of the bands.
+    mode='vrt' writes only a GDAL VRT referencing the source bands, without copying any pixels; it can be
+    read like the GeoTIFF or written out later with vrt_stack.materialize_vrt.
+    """
+    if mode not in ('tiff', 'vrt'):
+        raise ValueError(f"Unknown stack mode: {mode}")
+
     input_dir_name = os.path.basename(os.path.normpath(input_dir))
     # Create the output directory if it doesn't exist
     if not os.path.exists(output_dir):
@@ -21,25 +29,19 @@ def stack_layers(input_dir, output_dir):
             # Sort the bands to ensure consistent order
             bands.sort()
 
-            # Open the files as a list of rasterio datasets
-            datasets = [rasterio.open(fp) for fp in bands]
-
-            # Read the first dataset to get the metadata
-            meta = datasets[0].meta.copy()
-            meta.update(count=len(datasets))
-
             # Create the output file path
             relative_path = os.path.relpath(root, input_dir)
             output_folder = os.path.join(output_dir, relative_path)
             if not os.path.exists(output_folder):
                 os.makedirs(output_folder)
 
-            output_filepath = os.path.join(output_folder, f"{input_dir_name}.TIF")
-
-            # Write the stacked layers to the output file
-            with rasterio.open(output_filepath, 'w', **meta) as dest:
-                for idx, dataset in enumerate(datasets):
-                    dest.write_band(idx + 1, dataset.read(1, resampling=Resampling.bilinear))
+            if mode == 'vrt':
+                # Reference the bands by absolute path so the VRT stays valid wherever it is read from
+                output_filepath = os.path.join(output_folder, f"{input_dir_name}.vrt")
+                build_stack_vrt([os.path.abspath(band) for band in bands], output_filepath)
+            else:
+                output_filepath = os.path.join(output_folder, f"{input_dir_name}.TIF")
+                materialize_vrt(build_stack_vrt(bands), output_filepath, output_profile)
 
             print(f"Stacked image saved to: {output_filepath}")
 
@@ -47,4 +49,6 @@ def stack_layers(input_dir, output_dir):
 if __name__ == "__main__":
     input_directory = r"C:\Users\powelj\Documents\Aotea_test_files\Landsat\Clipped\LT04_L1TP_073085_19901216_20200915_02_T1"
     output_directory = r"C:\Users\powelj\Documents\Aotea_test_files\Landsat\Stacked"
-    stack_layers(input_directory, output_directory)
+    output_profile = "tiled"  # One of output_profile.OUTPUT_PROFILES: default, tiled, zstd, lzw or cog
+    mode = "tiff"  # 'tiff' to write a GeoTIFF, 'vrt' to write a virtual stack referencing the bands
+    stack_layers(input_directory, output_directory, output_profile, mode)
@@ -1,20 +1,262 @@
 import os
+import json
 import rasterio
-import matplotlib.pyplot as plt
+from matplotlib.backends.backend_agg import FigureCanvasAgg
+from matplotlib.figure import Figure
 import numpy as np
 from glob import glob
+from concurrent.futures import ProcessPoolExecutor, as_completed
 from rasterio.enums import Resampling
+from rasterio.windows import Window
+from file_utils import file_signature
 
+# Integer types narrow enough to count every possible value with np.bincount, then rebin exactly
+BINCOUNT_DTYPES = ('uint8', 'int8', 'uint16', 'int16')
+
+# Percentiles recorded with each band's statistics
+PERCENTILES = (2, 25, 50, 75, 98)
+
+# Sidecar file holding a raster's cached histograms and statistics
+STATS_SUFFIX = '.stats.json'
+
+
+def get_histogram_windows(src, window_size=1024):
+    # Full-width strips of window_size rows, so memory use doesn't grow with the raster's height
+    return [Window(0, row_off, src.width, min(window_size, src.height - row_off))
+            for row_off in range(0, src.height, window_size)]
+
+
+def count_values(read_chunks, num_bands, dtype):
+    # Count every value of a narrow integer type per band, offset so the type's minimum is at index 0
+    info = np.iinfo(dtype)
+    counts = np.zeros((num_bands, int(info.max) - int(info.min) + 1), dtype=np.int64)
+    for chunk in read_chunks():
+        for band in range(num_bands):
+            values = chunk[band].ravel()
+            if info.min:
+                values = values.astype(np.int32) - int(info.min)
+            counts[band] += np.bincount(values, minlength=counts.shape[1])
+    return counts, int(info.min)
+
+
+def empty_statistics(total):
+    return {'min': None, 'max': None, 'mean': None, 'std': None,
+            'percentiles': {str(q): None for q in PERCENTILES}, 'nodata_fraction': 1.0 if total else 0.0}
+
+
+def statistics_from_counts(band_counts, offset, nodata=None):
+    # Exact statistics of the valid pixels from per-value counts, percentiles interpolated as np.percentile
+    total = int(band_counts.sum())
+    band_counts = band_counts.copy()
+    if nodata is not None and float(nodata).is_integer() and 0 <= int(nodata) - offset < band_counts.size:
+        band_counts[int(nodata) - offset] = 0
+    present = np.flatnonzero(band_counts)
+    if present.size == 0:
+        return empty_statistics(total)
+
+    values = (present + offset).astype(np.float64)
+    weights = band_counts[present]
+    count = int(weights.sum())
+    mean = np.dot(values, weights) / count
+    cumulative = np.cumsum(weights)
+    percentiles = {}
+    for q in PERCENTILES:
+        position = q / 100 * (count - 1)
+        lower = values[np.searchsorted(cumulative, np.floor(position), side='right')]
+        upper = values[np.searchsorted(cumulative, np.ceil(position), side='right')]
+        percentiles[str(q)] = float(lower + (upper - lower) * (position - np.floor(position)))
+    return {'min': float(values[0]), 'max': float(values[-1]), 'mean': float(mean),
+            'std': float(np.sqrt(np.dot(weights, (values - mean) ** 2) / count)), 'percentiles': percentiles,
+            'nodata_fraction': 1 - count / total}
+
+
+def histograms_from_counts(counts, offset, bins=256, nodata=None):
+    # Rebin per-value counts into bins spanning each band's min to max, exactly as np.histogram on the data
+    histograms = []
+    for band_counts in counts:
+        present = np.flatnonzero(band_counts)
+        values = np.arange(present[0], present[-1] + 1) + offset
+        hist, bin_edges = np.histogram(values, bins=bins, range=(values[0], values[-1]),
+                                       weights=band_counts[present[0]:present[-1] + 1])
+        histogram = {'counts': hist.astype(np.int64), 'bin_edges': bin_edges}
+        histogram.update(statistics_from_counts(band_counts, offset, nodata))
+        histograms.append(histogram)
+    return histograms
+
+
+def finite_values(values):
+    if np.issubdtype(values.dtype, np.floating):
+        return values[np.isfinite(values)]
+    return values.ravel()
+
+
+def valid_values(values, nodata=None):
+    values = finite_values(values)
+    if nodata is not None and not np.isnan(nodata):
+        values = values[values != nodata]
+    return values
+
+
+def percentiles_from_histogram(counts, bin_edges):
+    # Percentiles interpolated within the bins of a histogram, accurate to a bin width
+    cumulative = np.concatenate([[0], np.cumsum(counts)])
+    return {str(q): float(np.interp(q / 100 * cumulative[-1], cumulative, bin_edges)) for q in PERCENTILES}
+
+
+def stream_histograms(read_chunks, num_bands, bins=256, nodata=None):
+    # Two passes for floating point or wide integer data: min/max per band, then fixed-range histograms.
+    # NaNs are left out of the histograms, and NaNs and nodata out of the statistics. The mean and variance
+    # of each chunk are merged with Chan's parallel algorithm, and the percentiles are estimated from a
+    # histogram of the valid pixels.
+    minimums = [None] * num_bands
+    maximums = [None] * num_bands
+    totals = [0] * num_bands
+    moments = [(0, 0.0, 0.0, None, None)] * num_bands  # count, mean, sum of squared deviations, min, max
+    for chunk in read_chunks():
+        for band in range(num_bands):
+            totals[band] += chunk[band].size
+            values = finite_values(chunk[band])
+            if values.size:
+                minimums[band] = values.min() if minimums[band] is None else min(minimums[band], values.min())
+                maximums[band] = values.max() if maximums[band] is None else max(maximums[band], values.max())
+            values = valid_values(values, nodata)
+            if values.size:
+                count, mean, m2, low, high = moments[band]
+                chunk_mean = values.mean(dtype=np.float64)
+                chunk_m2 = np.sum((values - chunk_mean) ** 2, dtype=np.float64)
+                delta = chunk_mean - mean
+                merged = count + values.size
+                moments[band] = (merged, mean + delta * values.size / merged,
+                                 m2 + chunk_m2 + delta ** 2 * count * values.size / merged,
+                                 values.min() if low is None else min(low, values.min()),
+                                 values.max() if high is None else max(high, values.max()))
+
+    counts = np.zeros((num_bands, bins), dtype=np.int64)
+    valid_counts = np.zeros((num_bands, bins), dtype=np.int64)
+    bin_edges = [np.linspace(0, 1, bins + 1)] * num_bands
+    for chunk in read_chunks():
+        for band in range(num_bands):
+            if minimums[band] is None:
+                continue
+            values = finite_values(chunk[band])
+            band_range = (minimums[band], maximums[band])
+            hist, bin_edges[band] = np.histogram(values, bins=bins, range=band_range)
+            counts[band] += hist
+            valid_counts[band] += np.histogram(valid_values(values, nodata), bins=bins, range=band_range)[0]
+
+    histograms = []
+    for band in range(num_bands):
+        count, mean, m2, low, high = moments[band]
+        histogram = {'counts': counts[band], 'bin_edges': bin_edges[band]}
+        if count:
+            percentiles = percentiles_from_histogram(valid_counts[band], bin_edges[band])
+            histogram.update({'min': float(low), 'max': float(high), 'mean': float(mean),
+                              'std': float(np.sqrt(m2 / count)),
+                              'percentiles': {q: min(max(v, float(low)), float(high)) for q, v in percentiles.items()},
+                              'nodata_fraction': 1 - count / totals[band]})
+        else:
+            histogram.update(empty_statistics(totals[band]))
+        histograms.append(histogram)
+    return histograms
+
+
+def compute_histograms(read_chunks, num_bands, dtype, bins=256, nodata=None):
+    """
+    Accumulate a histogram and statistics per band from chunks of (bands, rows, cols) data, where
+    read_chunks() returns an iterable of the chunks (called twice for floating point data).
+
+    Each band's result is a dict of 'counts' and 'bin_edges', with bins spanning the band's min to max as in
+    np.histogram, and the 'min', 'max', 'mean', 'std', 'percentiles' and 'nodata_fraction' of its valid
+    (finite, not nodata) pixels. Percentiles are exact for 8 and 16 bit integer data.
+    """
+    if np.dtype(dtype).name in BINCOUNT_DTYPES:
+        counts, offset = count_values(read_chunks, num_bands, dtype)
+        return histograms_from_counts(counts, offset, bins, nodata)
+    return stream_histograms(read_chunks, num_bands, bins, nodata)
+
+
+def raster_histograms(path, bins=256, window_size=1024):
+    """
+    Histogram every band of a raster, reading it in strips of window_size rows so memory use stays constant.
+    """
+    with rasterio.open(path) as src:
+        windows = get_histogram_windows(src, window_size)
+        return compute_histograms(lambda: (src.read(window=window) for window in windows), src.count,
+                                  src.dtypes[0], bins, src.nodata)
+
+
+def array_histograms(data, bins=256, nodata=None):
+    """
+    Histogram every band of an in-memory (bands, rows, cols) array.
+    """
+    return compute_histograms(lambda: [data], data.shape[0], data.dtype, bins, nodata)
+
+
+def load_statistics(path, bins=256):
+    """
+    Return a raster's histograms and statistics from its .stats.json sidecar, or None if there is no sidecar
+    or the raster has changed since it was written.
+    """
+    stats_path = path + STATS_SUFFIX
+    if not os.path.exists(stats_path):
+        return None
+    try:
+        with open(stats_path) as f:
+            cached = json.load(f)
+    except ValueError:
+        return None
+    if (cached.get('signature') != file_signature(path) or cached.get('bins') != bins
+            or cached.get('percentiles') != list(PERCENTILES)):
+        return None
+
+    histograms = cached['bands']
+    for histogram in histograms:
+        histogram['counts'] = np.array(histogram['counts'], dtype=np.int64)
+        histogram['bin_edges'] = np.array(histogram['bin_edges'])
+    return histograms
 
-def create_histogram_line_graph(data, title, output_path, avg_height=None, raw=False):
-    plt.figure(figsize=(10, 6))
+
+def save_statistics(path, histograms, bins=256):
+    """
+    Write a raster's histograms and statistics to its .stats.json sidecar, keyed by the raster's mtime and size.
+    """
+    bands = []
+    for histogram in histograms:
+        band = dict(histogram)
+        band['counts'] = histogram['counts'].tolist()
+        band['bin_edges'] = histogram['bin_edges'].tolist()
+        bands.append(band)
+    stats_path = path + STATS_SUFFIX
+    with open(stats_path + '.tmp', 'w') as f:
+        json.dump({'signature': file_signature(path), 'bins': bins, 'percentiles': list(PERCENTILES),
+                   'bands': bands}, f)
+    os.replace(stats_path + '.tmp', stats_path)
+
+
+def get_raster_statistics(path, bins=256, window_size=1024):
+    """
+    Histograms and statistics of a raster, from its sidecar if the raster is unchanged, else computed and
+    cached.
+    """
+    histograms = load_statistics(path, bins)
+    if histograms is None:
+        histograms = raster_histograms(path, bins, window_size)
+        save_statistics(path, histograms, bins)
+    return histograms
+
+
+def plot_histograms(histograms, title, output_path, avg_height=None, raw=False):
+    # Render with the object-oriented Agg API rather than pyplot, so no global figure state is shared and
+    # plots can be drawn in parallel processes
+    fig = Figure(figsize=(10, 6))
+    FigureCanvasAgg(fig)
+    ax = fig.add_subplot()
 
     all_heights = []
     max_height = 0
-    for band in range(1, data.shape[0] + 1):
-        band_data = data[band - 1]
-        hist, bins = np.histogram(band_data, bins=256, range=(np.min(band_data), np.max(band_data)))
-        plt.plot(bins[:-1], hist, label=f'Band {band}')
+    for band, histogram in enumerate(histograms, start=1):
+        hist = histogram['counts']
+        ax.plot(histogram['bin_edges'][:-1], hist, label=f'Band {band}')
         all_heights.append(hist)
         if raw:
             max_height = max(max_height, hist.max())
@@ -24,36 +266,138 @@ def create_histogram_line_graph(data, title, output_path, avg_height=None, raw=F
         all_heights = np.array(all_heights)
         avg_height = np.mean(all_heights)
 
-    plt.title(title)
-    plt.xlabel('Pixel Value')
-    plt.ylabel('Frequency')
+    ax.set_title(title)
+    ax.set_xlabel('Pixel Value')
+    ax.set_ylabel('Frequency')
 
     if raw:
-        plt.ylim(0, max_height)
+        ax.set_ylim(0, max_height)
     else:
-        plt.ylim(0, avg_height)  # Set y-axis limit to the average height of all bands
+        ax.set_ylim(0, avg_height)  # Set y-axis limit to the average height of all bands
 
-    plt.legend(loc='upper right')
-    plt.grid(True)
-    plt.savefig(output_path)
-    plt.close()
+    ax.legend(loc='upper right')
+    ax.grid(True)
+    fig.savefig(output_path)
 
 
-def resize_image_to_match_shape(image, target_shape):
+def create_histogram_line_graph(data, title, output_path, avg_height=None, raw=False):
+    plot_histograms(array_histograms(data), title, output_path, avg_height, raw)
+
+
+def resize_image_to_match_shape(image, target_shape=None):
+    # Read only the first band, resampled on read to target_shape (or at its own shape if None)
     with rasterio.open(image) as src:
-        data = src.read(
-            out_shape=(
-                src.count,
-                target_shape[0],
-                target_shape[1]
-            ),
-            resampling=Resampling.bilinear
-        )
-        return data[0]  # We only need the first band
+        if target_shape is None:
+            return src.read(1)
+        return src.read(1, out_shape=target_shape, resampling=Resampling.bilinear)
+
+
+def plot_up_to_date(path, output_path):
+    # A plot is current if it was rendered after the raster's statistics were cached
+    stats_path = path + STATS_SUFFIX
+    return os.path.exists(output_path) and os.path.getmtime(output_path) >= os.path.getmtime(stats_path)
+
+
+def histogram_title(file, label):
+    short_name = file[:13]
+    mask_info = []
+    if 'mclds' in file:
+        mask_info.append('cloud masked')
+    if 'topshad' in file:
+        mask_info.append('shadow masked')
+    mask_info_str = " | ".join(mask_info) if mask_info else ""
+    return f'{label} Histogram for {short_name} | {mask_info_str}'
+
+
+def raster_histogram_task(path, label, output_path, plot=True):
+    """
+    Histogram a raster with get_raster_statistics and plot it to output_path unless the plot is newer than
+    the raster's sidecar. Returns the histograms and a progress message.
+    """
+    histograms = get_raster_statistics(path)
+    if not plot:
+        return histograms, f"Statistics for {os.path.basename(path)} are up to date"
+    if plot_up_to_date(path, output_path):
+        return histograms, f"Histogram for {os.path.basename(path)} is up to date"
+    plot_histograms(histograms, histogram_title(os.path.basename(path), label), output_path)
+    return histograms, f"Created {label} histogram for {os.path.basename(path)}"
+
+
+def raw_histogram_task(safe_dir, output_path, plot=True):
+    """
+    Histogram the raw Sentinel-2 bands 1-10 of a .SAFE product, resampled to the first band's shape, and plot
+    them to output_path. Returns the histograms (None if there are no bands) and a progress message.
+    """
+    dir_name = os.path.basename(safe_dir)
+    jp2_files = glob(os.path.join(safe_dir, 'GRANULE', '*', 'IMG_DATA', '*.jp2'))
+
+    # Filter for bands 1-10
+    jp2_files = [f for f in jp2_files if any(band in f for band in [f'B0{i}.jp2' for i in range(1, 11)])]
+
+    # Histogram each band as it is read, so only one band is held in memory
+    raw_histograms = []
+    errors = []
+    target_shape = None
+    for jp2_file in jp2_files:
+        try:
+            band_data = resize_image_to_match_shape(jp2_file, target_shape)
+            if target_shape is None:
+                target_shape = band_data.shape
+            raw_histograms.extend(array_histograms(band_data[np.newaxis]))
+        except Exception as e:
+            errors.append(f"Error reading {jp2_file}: {e}")
+
+    if not raw_histograms:
+        return None, "\n".join(errors)
+    if plot:
+        title = f'Raw Sentinel-2 Histogram for {dir_name}'
+        plot_histograms(raw_histograms, title, output_path, raw=True)
+    return raw_histograms, "\n".join(errors + [f"Created Raw Sentinel-2 histogram for {dir_name}"])
+
+
+def run_histogram_tasks(task, jobs, workers=1):
+    """
+    Run histogram tasks serially or, with workers > 1, on a process pool, printing each task's progress
+    message as soon as it finishes. Returns the histograms keyed by each job's first argument, in job order.
+    """
+    results = {}
+
+    def report(key, result, message):
+        if message:
+            print(message)
+        if result is not None:
+            results[key] = result
+
+    if workers > 1:
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            futures = {executor.submit(task, *job): job[0] for job in jobs}
+            for future in as_completed(futures):
+                key = futures.pop(future)
+                try:
+                    report(key, *future.result())
+                except Exception as e:
+                    print(f"Error processing {key}: {e}")
+    else:
+        for job in jobs:
+            try:
+                report(job[0], *task(*job))
+            except Exception as e:
+                print(f"Error processing {job[0]}: {e}")
+
+    return {job[0]: results[job[0]] for job in jobs if job[0] in results}
 
 
 def generate_histograms(output_dir, surface_reflectance_end, radiance_end, raw_data_dir=None,
-                        raw_histogram_output_dir=None):
+                        raw_histogram_output_dir=None, workers=1, plot=True):
+    """
+    Plot histograms of the surface reflectance and radiance rasters below output_dir, and of the raw
+    Sentinel-2 bands if raw_data_dir is given. Returns the histograms keyed by raster (or .SAFE) path.
+
+    Each raster's histograms and band statistics are cached in a .stats.json sidecar. Unchanged rasters are
+    not read again, and their plots are only redrawn if missing. With workers > 1 rasters are processed and
+    plotted on a process pool, and plot=False computes the statistics without rendering any plots.
+    """
+    jobs = []
     for root, dirs, files in os.walk(output_dir):
         if any(file.endswith(surface_reflectance_end) or file.endswith(radiance_end) for file in files):
             sr_files = [f for f in files if f.endswith(surface_reflectance_end)]
@@ -61,85 +405,34 @@ def generate_histograms(output_dir, surface_reflectance_end, radiance_end, raw_d
 
             # Create histogram directory within the current image folder
             histogram_dir = os.path.join(root, "histogram")
-            if not os.path.exists(histogram_dir):
+            if plot and not os.path.exists(histogram_dir):
                 os.makedirs(histogram_dir)
 
             for sr_file in sr_files:
-                sr_path = os.path.join(root, sr_file)
-                try:
-                    with rasterio.open(sr_path) as src:
-                        sr_data = src.read()
-                        short_name = sr_file[:13]
-                        mask_info = []
-                        if 'mclds' in sr_file:
-                            mask_info.append('cloud masked')
-                        if 'topshad' in sr_file:
-                            mask_info.append('shadow masked')
-                        mask_info_str = " | ".join(mask_info) if mask_info else ""
-                        title = f'Surface Reflectance Histogram for {short_name} | {mask_info_str}'
-                        output_path = os.path.join(histogram_dir,
-                                                   f"{os.path.basename(sr_file).replace('.tif', '')}_sr_hist.png")
-                        create_histogram_line_graph(sr_data, title, output_path)
-                        print(f"Created Surface Reflectance histogram for {sr_file}")
-                except Exception as e:
-                    print(f"Error processing {sr_file}: {e}")
+                output_path = os.path.join(histogram_dir,
+                                           f"{os.path.basename(sr_file).replace('.tif', '')}_sr_hist.png")
+                jobs.append((os.path.join(root, sr_file), 'Surface Reflectance', output_path, plot))
 
             for rad_file in rad_files:
-                rad_path = os.path.join(root, rad_file)
-                try:
-                    with rasterio.open(rad_path) as src:
-                        rad_data = src.read()
-                        short_name = rad_file[:13]
-                        mask_info = []
-                        if 'mclds' in rad_file:
-                            mask_info.append('cloud masked')
-                        if 'topshad' in rad_file:
-                            mask_info.append('shadow masked')
-                        mask_info_str = " | ".join(mask_info) if mask_info else ""
-                        title = f'Radiance Histogram for {short_name} | {mask_info_str}'
-                        output_path = os.path.join(histogram_dir,
-                                                   f"{os.path.basename(rad_file).replace('.tif', '')}_rad_hist.png")
-                        create_histogram_line_graph(rad_data, title, output_path)
-                        print(f"Created Radiance histogram for {rad_file}")
-                except Exception as e:
-                    print(f"Error processing {rad_file}: {e}")
+                output_path = os.path.join(histogram_dir,
+                                           f"{os.path.basename(rad_file).replace('.tif', '')}_rad_hist.png")
+                jobs.append((os.path.join(root, rad_file), 'Radiance', output_path, plot))
+
+    histograms = run_histogram_tasks(raster_histogram_task, jobs, workers)
 
     if raw_data_dir and raw_histogram_output_dir:
-        generate_raw_histograms(raw_data_dir, raw_histogram_output_dir)
+        histograms.update(generate_raw_histograms(raw_data_dir, raw_histogram_output_dir, workers, plot))
+    return histograms
 
 
-def generate_raw_histograms(raw_data_dir, raw_histogram_output_dir):
+def generate_raw_histograms(raw_data_dir, raw_histogram_output_dir, workers=1, plot=True):
+    jobs = []
     for root, dirs, files in os.walk(raw_data_dir):
         for dir_name in dirs:
             if dir_name.endswith('.SAFE'):
-                safe_dir = os.path.join(root, dir_name)
-                jp2_files = glob(os.path.join(safe_dir, 'GRANULE', '*', 'IMG_DATA', '*.jp2'))
-
-                # Filter for bands 1-10
-                jp2_files = [f for f in jp2_files if any(band in f for band in [f'B0{i}.jp2' for i in range(1, 11)])]
-
-                if not jp2_files:
-                    continue
-
-                raw_data = []
-                target_shape = None
-                for jp2_file in jp2_files:
-                    try:
-                        with rasterio.open(jp2_file) as src:
-                            if target_shape is None:
-                                target_shape = src.shape
-                            band_data = resize_image_to_match_shape(jp2_file, target_shape)
-                            raw_data.append(band_data)
-                    except Exception as e:
-                        print(f"Error reading {jp2_file}: {e}")
-
-                if raw_data:
-                    raw_data = np.stack(raw_data)
-                    title = f'Raw Sentinel-2 Histogram for {dir_name}'
-                    output_path = os.path.join(raw_histogram_output_dir, f"{dir_name}_raw_hist.png")
-                    max_height = np.max([np.histogram(band_data, bins=256)[0].max() for band_data in raw_data])
-                    create_histogram_line_graph(raw_data, title, output_path, avg_height=max_height, raw=True)
-                    print(f"Created Raw Sentinel-2 histogram for {dir_name}")
+                output_path = os.path.join(raw_histogram_output_dir, f"{dir_name}_raw_hist.png")
+                jobs.append((os.path.join(root, dir_name), output_path, plot))
+    return run_histogram_tasks(raw_histogram_task, jobs, workers)
 
 
 if __name__ == "__main__":
@@ -150,6 +443,9 @@ if __name__ == "__main__":
     raw_sentinel_dir = r"C:\Users\powelj\Documents\Aotea_test_files\Sentinel\RAW"
     raw_histogram_output_dir = r"C:\Users\powelj\Documents\Aotea_test_files\Sentinel\Raw_Histograms"
 
+    workers = 4  # Number of rasters histogrammed and plotted in parallel
+    plot = True  # False to compute and cache statistics without rendering plots
+
     # Generate histograms
     generate_histograms(output_directory, surface_reflectance_end, radiance_end, raw_sentinel_dir,
-                        raw_histogram_output_dir)
+                        raw_histogram_output_dir, workers, plot)
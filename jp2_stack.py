@@ -1,37 +1,46 @@
-import rasterio
 import glob
 import os
 import re
+from vrt_stack import build_stack_vrt, materialize_vrt
 
-# Directory where the 10-meter .jp2 files are stored
-input_dir = r"C:\Users\powelj\Documents\Aotea_test_files\Sentinel\RAW\2023\S2B_MSIL1C_20231224T222549_N0510_R029_T60HUE_20231224T232042\S2B_MSIL1C_20231224T222549_N0510_R029_T60HUE_20231224T232042.SAFE\GRANULE\L1C_T60HUE_A035519_20231224T222543\IMG_DATA"
-output_dir = r"C:\Users\powelj\Documents\Aotea_test_files\Sentinel\Outputs"
-output_file = os.path.join(output_dir, "sentinel_stacked.tif")
+# Pattern to match the 10-meter bands (B02, B03, B04, B08)
+BAND_PATTERN = re.compile(r'B0[2348].jp2$')
 
-# Ensure the output directory exists
-if not os.path.exists(output_dir):
-    os.makedirs(output_dir)
 
-# Define a pattern to match the 10-meter bands (B02, B03, B04, B08)
-pattern = re.compile(r'B0[2348].jp2$')
+def stack_jp2_bands(input_dir, output_file, output_profile='default', mode='tiff'):
+    """
+    Stack the 10-meter Sentinel-2 .jp2 bands in an IMG_DATA folder.
 
-# Find all .jp2 files in the input directory that match the pattern
-jp2_files = [f for f in glob.glob(os.path.join(input_dir, "*.jp2")) if pattern.search(f)]
+    mode='tiff' writes a GeoTIFF, streamed window by window from a virtual stack of the bands.
+    mode='vrt' writes only a GDAL VRT referencing the .jp2 files, without decoding or copying any pixels.
+    """
+    if mode not in ('tiff', 'vrt'):
+        raise ValueError(f"Unknown stack mode: {mode}")
 
-# Ensure the files are sorted to maintain band order (optional: you can sort based on your requirement)
-jp2_files.sort()
+    # Find all .jp2 files in the input directory that match the pattern
+    jp2_files = [f for f in glob.glob(os.path.join(input_dir, "*.jp2")) if BAND_PATTERN.search(f)]
 
-# Open the first file to get the metadata
-with rasterio.open(jp2_files[0]) as src0:
-    meta = src0.meta
+    # Ensure the files are sorted to maintain band order
+    jp2_files.sort()
 
-# Update metadata to reflect the number of layers
-meta.update(count=len(jp2_files), driver='GTiff')
+    if mode == 'vrt':
+        build_stack_vrt([os.path.abspath(f) for f in jp2_files], output_file)
+    else:
+        materialize_vrt(build_stack_vrt(jp2_files), output_file, output_profile)
+    return output_file
 
-# Read each layer and write it to stack
-with rasterio.open(output_file, 'w', **meta) as dst:
-    for id, layer in enumerate(jp2_files, start=1):
-        with rasterio.open(layer) as src1:
-            dst.write_band(id, src1.read(1))
 
-print(f"Stacked GeoTIFF file saved as {output_file}")
+if __name__ == "__main__":
+    # Directory where the 10-meter .jp2 files are stored
+    input_dir = r"C:\Users\powelj\Documents\Aotea_test_files\Sentinel\RAW\2023\S2B_MSIL1C_20231224T222549_N0510_R029_T60HUE_20231224T232042\S2B_MSIL1C_20231224T222549_N0510_R029_T60HUE_20231224T232042.SAFE\GRANULE\L1C_T60HUE_A035519_20231224T222543\IMG_DATA"
+    output_dir = r"C:\Users\powelj\Documents\Aotea_test_files\Sentinel\Outputs"
+    output_profile = "tiled"  # One of output_profile.OUTPUT_PROFILES: default, tiled, zstd, lzw or cog
+    mode = "tiff"  # 'tiff' to write a GeoTIFF, 'vrt' to write a virtual stack referencing the bands
+    output_file = os.path.join(output_dir, "sentinel_stacked.vrt" if mode == 'vrt' else "sentinel_stacked.tif")
+
+    # Ensure the output directory exists
+    if not os.path.exists(output_dir):
+        os.makedirs(output_dir)
+
+    stack_jp2_bands(input_dir, output_file, output_profile, mode)
+    print(f"Stacked file saved as {output_file}")
@@ -1,20 +1,66 @@
 import os
 import shutil
+import threading
+from concurrent.futures import ThreadPoolExecutor
 import rasterio
 import geopandas as gpd
-from rasterio.mask import mask
+from rasterio.mask import raster_geometry_mask
+from output_profile import get_output_meta, finalize_output
+from file_utils import hardlink_file
 
+# How non-raster (MTL, ANG, QA text) files are carried into the output tree
+ANCILLARY_MODES = ('copy', 'hardlink', 'skip')
 
-def clip_raster(input_filepath, output_filepath, shapefile):
-    # Read the shapefile using geopandas
-    shapes = gpd.read_file(shapefile)
 
-    # Convert the shapes to GeoJSON format
-    geoms = shapes.geometry.values
+class ClipAOI:
+    """
+    An AOI shapefile loaded once per run. Its geometries are cached reprojected to each raster CRS, and the
+    clip window and shape mask are cached per raster grid (CRS, transform and shape), so scenes on the same
+    WRS path/row reuse them. The caches are shared safely between threads.
+    """
+
+    def __init__(self, shapefile):
+        # Read the shapefile using geopandas
+        self.shapes = gpd.read_file(shapefile)
+        self._geometries = {}
+        self._grids = {}
+        self._lock = threading.RLock()
+
+    def geometries(self, crs):
+        """
+        The AOI geometries in a raster's CRS.
+        """
+        key = crs.to_wkt() if crs else None
+        with self._lock:
+            if key not in self._geometries:
+                shapes = self.shapes
+                if shapes.crs is not None and crs is not None:
+                    shapes = shapes.to_crs(key)
+                self._geometries[key] = shapes.geometry.values
+            return self._geometries[key]
+
+    def clip_grid(self, src):
+        """
+        The shape mask, transform and window of a raster clipped to the AOI, as used by rasterio.mask.mask
+        with crop=True.
+        """
+        key = (src.crs.to_wkt() if src.crs else None, src.transform, src.width, src.height)
+        with self._lock:
+            if key not in self._grids:
+                self._grids[key] = raster_geometry_mask(src, self.geometries(src.crs), crop=True)
+            return self._grids[key]
+
+
+def clip_raster(input_filepath, output_filepath, shapefile, output_profile='default'):
+    # Load the AOI, unless a ClipAOI shared between calls is passed in
+    aoi = shapefile if isinstance(shapefile, ClipAOI) else ClipAOI(shapefile)
 
     with rasterio.open(input_filepath) as src:
-        # Clip the raster using the shapefile
-        out_image, out_transform = mask(src, geoms, crop=True)
+        # Read only the window covering the AOI, and set pixels outside it to nodata (0 if there is none)
+        shape_mask, out_transform, window = aoi.clip_grid(src)
+        out_image = src.read(window=window, masked=True)
+        out_image.mask = out_image.mask | shape_mask
+        out_image = out_image.filled(src.nodata if src.nodata is not None else 0)
 
         # Update the metadata with the new dimensions, transform, and CRS
         out_meta = src.meta.copy()
@@ -26,36 +72,80 @@ def clip_raster(input_filepath, output_filepath, shapefile):
             "crs": src.crs
         })
 
-        # Write the clipped raster to the output file
-        with rasterio.open(output_filepath, "w", **out_meta) as dest:
+        # Write the clipped raster to a partial file, renamed once complete so an interrupted clip is never
+        # mistaken for an up to date output
+        partial_filepath = output_filepath + '.partial'
+        with rasterio.open(partial_filepath, "w", **get_output_meta(out_meta, output_profile)) as dest:
             dest.write(out_image)
+    finalize_output(partial_filepath, output_profile)
+    os.replace(partial_filepath, output_filepath)
 
     print(f"Clipped file: {input_filepath} to {output_filepath}")
 
 
-def batch_clip(input_dir, output_dir, shapefile):
+def is_up_to_date(input_filepath, output_filepath):
+    # An output is current if it was written after its input was last modified
+    return os.path.exists(output_filepath) and os.path.getmtime(output_filepath) >= os.path.getmtime(input_filepath)
+
+
+def copy_ancillary(input_filepath, output_filepath, ancillary='copy'):
+    # Carry a non-raster file into the output tree by copying or hardlinking it
+    if ancillary == 'hardlink':
+        if os.path.exists(output_filepath):
+            os.remove(output_filepath)
+        hardlink_file(input_filepath, output_filepath)
+    else:
+        shutil.copy(input_filepath, output_filepath)
+
+
+def batch_clip(input_dir, output_dir, shapefile, output_profile='default', workers=1, ancillary='copy',
+               overwrite=False):
+    """
+    Clip every .TIF below input_dir to the AOI, mirroring the folder structure in output_dir.
+
+    Rasters are clipped on a pool of `workers` threads, as the work is I/O bound and rasterio releases the
+    GIL while reading and writing. Non-raster files are copied, hardlinked or skipped according to
+    `ancillary`. Outputs newer than their inputs are left alone unless overwrite is set.
+    """
+    if ancillary not in ANCILLARY_MODES:
+        raise ValueError(f"Unknown ancillary mode: {ancillary}")
+
     if not os.path.exists(output_dir):
         os.makedirs(output_dir)
 
-    for root, dirs, files in os.walk(input_dir):
-        relative_path = os.path.relpath(root, input_dir)
-        output_folder = os.path.join(output_dir, relative_path)
+    # Load the AOI once for every raster
+    aoi = ClipAOI(shapefile)
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = []
+        for root, dirs, files in os.walk(input_dir):
+            relative_path = os.path.relpath(root, input_dir)
+            output_folder = os.path.join(output_dir, relative_path)
 
-        if not os.path.exists(output_folder):
-            os.makedirs(output_folder)
+            if not os.path.exists(output_folder):
+                os.makedirs(output_folder)
 
-        for file in files:
-            if file.endswith('.TIF'):  # Assuming the Landsat files are in GeoTIFF format
+            for file in files:
                 input_filepath = os.path.join(root, file)
                 output_filepath = os.path.join(output_folder, file)
-                clip_raster(input_filepath, output_filepath, shapefile)
-            else:
-                # Copy non-raster files as they are
-                shutil.copy(os.path.join(root, file), os.path.join(output_folder, file))
+                if not overwrite and is_up_to_date(input_filepath, output_filepath):
+                    continue
+                if file.endswith('.TIF'):  # Assuming the Landsat files are in GeoTIFF format
+                    futures.append(executor.submit(clip_raster, input_filepath, output_filepath, aoi,
+                                                   output_profile))
+                elif ancillary != 'skip':
+                    # Carry non-raster files over as they are
+                    copy_ancillary(input_filepath, output_filepath, ancillary)
+
+        for future in futures:
+            future.result()
 
 
 if __name__ == "__main__":
     input_directory = r"C:\Users\powelj\Documents\Aotea_test_files\Landsat\tmp"
     output_directory = r"C:\Users\powelj\Documents\Aotea_test_files\Landsat\Inputs"
     shapefile_path = r"C:\Users\powelj\Documents\Aotea_test_files\Landsat\aotea_landsat_aoi"
-    batch_clip(input_directory, output_directory, shapefile_path)
+    output_profile = "tiled"  # One of output_profile.OUTPUT_PROFILES: default, tiled, zstd, lzw or cog
+    workers = 4  # Number of rasters clipped concurrently
+    ancillary = "hardlink"  # How MTL, ANG and QA text files are carried over: copy, hardlink or skip
+    batch_clip(input_directory, output_directory, shapefile_path, output_profile, workers, ancillary)
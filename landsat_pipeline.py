@@ -0,0 +1,133 @@
+import os
+import math
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import ExitStack
+import numpy as np
+import rasterio
+from rasterio.crs import CRS
+from rasterio.features import geometry_mask
+from rasterio.transform import from_origin
+from rasterio.vrt import WarpedVRT
+from rasterio.warp import calculate_default_transform, Resampling
+from landsat_clip import ClipAOI, is_up_to_date
+from output_profile import get_output_meta, get_output_windows, finalize_output
+
+
+def find_scene_bands(input_dir, bands=None):
+    """
+    Map each folder below input_dir holding .TIF bands to its sorted band files. bands (e.g. ['B2', 'B3', 'B4'])
+    keeps only files ending in _<band>.TIF, in that order.
+    """
+    scenes = {}
+    for root, dirs, files in os.walk(input_dir):
+        band_files = sorted(os.path.join(root, file) for file in files if file.endswith('.TIF'))
+        if bands is not None:
+            band_files = [f for band in bands for f in band_files if f.endswith(f'_{band}.TIF')]
+        if band_files:
+            scenes[root] = band_files
+    return scenes
+
+
+def get_aoi_grid(aoi, src, dst_crs, resolution=None):
+    """
+    The output grid covering the AOI in dst_crs: its transform, width and height. Pixels are aligned to
+    multiples of the resolution, so every scene clipped to the same AOI lands on the same grid. Without a
+    resolution the one GDAL would choose for reprojecting the whole scene is used.
+    """
+    if resolution is None:
+        transform, _, _ = calculate_default_transform(src.crs, dst_crs, src.width, src.height, *src.bounds)
+        resolution = transform.a
+
+    # AOI bounds snapped outward to the pixel grid
+    left, bottom, right, top = aoi.geometries(dst_crs).total_bounds
+    left = math.floor(left / resolution) * resolution
+    bottom = math.floor(bottom / resolution) * resolution
+    right = math.ceil(right / resolution) * resolution
+    top = math.ceil(top / resolution) * resolution
+    width = int(round((right - left) / resolution))
+    height = int(round((top - bottom) / resolution))
+    return from_origin(left, top, resolution, resolution), width, height
+
+
+def process_scene(band_files, output_file, aoi, dst_crs='EPSG:2193', resolution=None,
+                  resampling=Resampling.bilinear, output_profile='default'):
+    """
+    Clip, reproject and stack a scene's bands in one pass. Each band is read through a WarpedVRT onto the AOI
+    grid in dst_crs, so only the source blocks under the AOI are read, and the stacked output is written
+    window by window with pixels outside the AOI set to nodata (0 if the bands have none). No intermediate
+    clipped or reprojected files are written.
+    """
+    dst_crs = CRS.from_user_input(dst_crs)
+    with rasterio.open(band_files[0]) as src0:
+        transform, width, height = get_aoi_grid(aoi, src0, dst_crs, resolution)
+        nodata = src0.nodata if src0.nodata is not None else 0
+        meta = src0.meta.copy()
+
+    # Rasterise the AOI once on the output grid
+    outside = geometry_mask(aoi.geometries(dst_crs), out_shape=(height, width), transform=transform)
+
+    dtypes = []
+    for band_file in band_files:
+        with rasterio.open(band_file) as src:
+            dtypes.append(src.dtypes[0])
+    meta.update(driver='GTiff', crs=dst_crs, transform=transform, width=width, height=height,
+                count=len(band_files), dtype=np.result_type(*dtypes).name, nodata=nodata)
+
+    partial_file = output_file + '.partial'
+    with ExitStack() as stack:
+        vrts = [stack.enter_context(WarpedVRT(stack.enter_context(rasterio.open(band_file)), crs=dst_crs,
+                                              transform=transform, width=width, height=height,
+                                              resampling=resampling, nodata=nodata))
+                for band_file in band_files]
+        dst = stack.enter_context(rasterio.open(partial_file, 'w', **get_output_meta(meta, output_profile)))
+        for window in get_output_windows(dst):
+            data = np.stack([vrt.read(1, window=window) for vrt in vrts]).astype(dst.dtypes[0], copy=False)
+            data[:, outside[window.toslices()]] = nodata
+            dst.write(data, window=window)
+        dst.descriptions = tuple(os.path.basename(band_file) for band_file in band_files)
+    finalize_output(partial_file, output_profile)
+    os.replace(partial_file, output_file)
+
+    print(f"Processed scene: {os.path.dirname(band_files[0])} to {output_file}")
+
+
+def run_landsat_pipeline(input_dir, output_dir, shapefile, dst_crs='EPSG:2193', resolution=None, bands=None,
+                         resampling=Resampling.bilinear, output_profile='default', workers=1, overwrite=False):
+    """
+    Clip, reproject and stack every Landsat scene below input_dir, replacing landsat_clip.batch_clip,
+    landsat_reproject.process_landsat_data and geotiff_stack.stack_layers run in turn. Each scene folder
+    becomes <output_dir>/<scene>.TIF.
+
+    Scenes are processed on a pool of `workers` threads. Outputs newer than all of their bands are left alone
+    unless overwrite is set.
+    """
+    if not os.path.exists(output_dir):
+        os.makedirs(output_dir)
+
+    # Load the AOI once for every scene
+    aoi = ClipAOI(shapefile)
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = []
+        for scene_dir, band_files in find_scene_bands(input_dir, bands).items():
+            output_file = os.path.join(output_dir, f"{os.path.basename(scene_dir)}.TIF")
+            if not overwrite and all(is_up_to_date(band_file, output_file) for band_file in band_files):
+                continue
+            futures.append(executor.submit(process_scene, band_files, output_file, aoi, dst_crs, resolution,
+                                           resampling, output_profile))
+        for future in futures:
+            future.result()
+
+
+if __name__ == "__main__":
+    input_directory = r"C:\Users\powelj\Documents\Aotea_test_files\Landsat\tmp"
+    output_directory = r"C:\Users\powelj\Documents\Aotea_test_files\Landsat\Stacked"
+    shapefile_path = r"C:\Users\powelj\Documents\Aotea_test_files\Landsat\aotea_landsat_aoi"
+    dst_crs = "EPSG:2193"  # NZTM2000
+    resolution = 30  # Output pixel size in metres, or None for GDAL's choice
+    bands = None  # None for every .TIF in a scene, or a list such as ['B1', 'B2', 'B3', 'B4', 'B5', 'B7']
+    output_profile = "tiled"  # One of output_profile.OUTPUT_PROFILES: default, tiled, zstd, lzw or cog
+    workers = 4  # Number of scenes processed concurrently
+
+    run_landsat_pipeline(input_directory, output_directory, shapefile_path, dst_crs, resolution, bands,
+                         Resampling.bilinear, output_profile, workers)
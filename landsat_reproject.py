@@ -1,10 +1,20 @@
 import os
-import shutil
+from concurrent.futures import ProcessPoolExecutor
 import rasterio
+from rasterio.vrt import WarpedVRT
 from rasterio.warp import calculate_default_transform, reproject, Resampling
+from output_profile import get_output_meta, get_output_windows, finalize_output
 
 
-def reproject_raster(input_filepath, output_filepath, dst_crs='EPSG:2193'):
+def reproject_raster(input_filepath, output_filepath, dst_crs='EPSG:2193', output_profile='default', num_threads=1,
+                     warp_mem_limit=0, chunked=False, window_size=1024):
+    """
+    Reproject every band of a raster to dst_crs with bilinear resampling.
+
+    By default all bands are warped in a single call using num_threads threads and up to warp_mem_limit MB
+    of warp memory (0 for GDAL's default). With chunked=True the raster is instead read through a WarpedVRT
+    and written window by window, so memory use stays bounded for rasters too large to warp at once.
+    """
     with rasterio.open(input_filepath) as src:
         transform, width, height = calculate_default_transform(
             src.crs, dst_crs, src.width, src.height, *src.bounds)
@@ -17,46 +27,72 @@ def reproject_raster(input_filepath, output_filepath, dst_crs='EPSG:2193'):
             'height': height
         })
 
-        with rasterio.open(output_filepath, 'w', **kwargs) as dst:
-            for i in range(1, src.count + 1):
+        with rasterio.open(output_filepath, 'w', **get_output_meta(kwargs, output_profile)) as dst:
+            if chunked:
+                with WarpedVRT(src, crs=dst_crs, transform=transform, width=width, height=height,
+                               resampling=Resampling.bilinear, num_threads=num_threads,
+                               warp_mem_limit=warp_mem_limit) as vrt:
+                    for window in get_output_windows(dst, window_size):
+                        dst.write(vrt.read(window=window), window=window)
+            else:
+                bands = list(range(1, src.count + 1))
                 reproject(
-                    source=rasterio.band(src, i),
-                    destination=rasterio.band(dst, i),
+                    source=rasterio.band(src, bands),
+                    destination=rasterio.band(dst, bands),
                     src_transform=src.transform,
                     src_crs=src.crs,
                     dst_transform=transform,
                     dst_crs=dst_crs,
-                    resampling=Resampling.bilinear
+                    resampling=Resampling.bilinear,
+                    num_threads=num_threads,
+                    warp_mem_limit=warp_mem_limit
                 )
+    finalize_output(output_filepath, output_profile)
 
     print(f"Reprojected file: {input_filepath} to {output_filepath}")
 
 
-def process_landsat_data(input_dir, output_dir):
-    """if not os.path.exists(output_dir):
+def process_landsat_data(input_dir, output_dir, output_profile='default', dst_crs='EPSG:2193', workers=1,
+                         num_threads=1, warp_mem_limit=0, chunked=False):
+    """
+    Reproject every .tif below input_dir, mirroring the folder structure in output_dir. With workers > 1 the
+    files are reprojected in parallel on a process pool; num_threads, warp_mem_limit and chunked are passed
+    on to reproject_raster for each file.
+    """
+    if not os.path.exists(output_dir):
         os.makedirs(output_dir)
 
+    jobs = []
     for root, dirs, files in os.walk(input_dir):
         relative_path = os.path.relpath(root, input_dir)
-        output_folder = os.path.join(output_dir, relative_path)
-
-        if not os.path.exists(output_folder):
-            os.makedirs(output_folder)"""
+        output_folder = os.path.normpath(os.path.join(output_dir, relative_path))
 
-    for root, dirs, files in os.walk(input_dir):
         for file in files:
             if file.endswith('.tif'):
-                print(file)
-                input_filepath = os.path.join(input_dir, file)
-                output_filepath = os.path.join(output_dir, file)
-                reproject_raster(input_filepath, output_filepath)
-        """else:
-            shutil.copy(input_filepath, output_filepath)
-            print(f"Copied file: {input_filepath} to {output_filepath}")"""
+                if not os.path.exists(output_folder):
+                    os.makedirs(output_folder)
+                input_filepath = os.path.join(root, file)
+                output_filepath = os.path.join(output_folder, file)
+                jobs.append((input_filepath, output_filepath, dst_crs, output_profile, num_threads, warp_mem_limit,
+                             chunked))
+
+    if workers > 1:
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            futures = [executor.submit(reproject_raster, *job) for job in jobs]
+            for future in futures:
+                future.result()
+    else:
+        for job in jobs:
+            reproject_raster(*job)
 
 
 if __name__ == "__main__":
     input_directory = r"C:\Users\powelj\Documents\Aotea_test_files\Retrolens\tmp"
     output_directory = r"C:\Users\powelj\Documents\Aotea_test_files\Retrolens\Outputs"
-    # process_landsat_data(input_directory, output_directory)
-    process_landsat_data(input_directory, output_directory)
+    output_profile = "tiled"  # One of output_profile.OUTPUT_PROFILES: default, tiled, zstd, lzw or cog
+    workers = 4  # Number of files reprojected in parallel
+    num_threads = 2  # Warp threads per file
+    warp_mem_limit = 512  # Warp memory per file in MB, 0 for GDAL's default
+    chunked = False  # True to warp window by window through a WarpedVRT, for rasters too large to warp at once
+    process_landsat_data(input_directory, output_directory, output_profile, workers=workers,
+                         num_threads=num_threads, warp_mem_limit=warp_mem_limit, chunked=chunked)
@@ -1,10 +1,14 @@
 import os
-import subprocess
 import glob
-import tempfile
+from mosaic import mosaic_files
 
 
-def merge_tif_files(input_dir, output_dir, output_filename):
+def merge_tif_files(input_dir, output_dir, output_filename, method='last', nodata=None, output_profile='default',
+                    workers=1):
+    """
+    Mosaic every .tif file in input_dir into output_filename in-process, see mosaic.mosaic_files. The
+    default method 'last' keeps the later file where files overlap, as gdal_merge did.
+    """
     # Ensure the output directory exists
     if not os.path.exists(output_dir):
         os.makedirs(output_dir)
@@ -19,20 +23,8 @@ def merge_tif_files(input_dir, output_dir, output_filename):
         print(f"No .tif files found in {input_dir}")
         return
 
-    # Create a temporary file to hold the list of .tif files
-    with tempfile.NamedTemporaryFile(delete=False, mode='w') as tmpfile:
-        tmpfile_name = tmpfile.name
-        for tif_file in tif_files:
-            tmpfile.write(tif_file + '\n')
-
-    # Prepare the gdal_merge.py command
-    cmd = f'gdal_merge -o {output_filepath} --optfile {tmpfile_name}'
-
-    # Execute the command
-    subprocess.call(cmd, shell=True)
-
-    # Clean up the temporary file
-    os.remove(tmpfile_name)
+    mosaic_files(tif_files, output_filepath, method=method, nodata=nodata, output_profile=output_profile,
+                 workers=workers)
 
     print(f"Merged .tif files into: {output_filepath}")
 
@@ -41,5 +33,9 @@ if __name__ == "__main__":
     input_directory = r"C:\Users\powelj\Documents\Aotea_test_files\Landsat\dem"
     output_directory = r"C:\Users\powelj\Documents\Aotea_test_files\Landsat"
     output_filename = "merged_dem.tif"
+    method = "last"  # One of mosaic.MERGE_METHODS: first, last, min, max or mean
+    output_profile = "tiled"  # One of output_profile.OUTPUT_PROFILES: default, tiled, zstd, lzw or cog
+    workers = 4  # Number of output windows merged in parallel
 
-    merge_tif_files(input_directory, output_directory, output_filename)
\ No newline at end of file
+    merge_tif_files(input_directory, output_directory, output_filename, method, output_profile=output_profile,
+                    workers=workers)
\ No newline at end of file
@@ -1,10 +1,13 @@
 import os
-import subprocess
 import glob
-import tempfile
+from mosaic import mosaic_files
 
 
-def merge_kea_files(input_dir, output_dir, output_filename):
+def merge_kea_files(input_dir, output_dir, output_filename, method='last', nodata=None, workers=1):
+    """
+    Mosaic every .kea file in input_dir into output_filename in-process, see mosaic.mosaic_files. The
+    default method 'last' keeps the later file where files overlap, as gdal_merge did.
+    """
     # Ensure the output directory exists
     if not os.path.exists(output_dir):
         os.makedirs(output_dir)
@@ -19,20 +22,7 @@ def merge_kea_files(input_dir, output_dir, output_filename):
         print(f"No .kea files found in {input_dir}")
         return
 
-    # Create a temporary file to hold the list of .kea files
-    with tempfile.NamedTemporaryFile(delete=False, mode='w') as tmpfile:
-        tmpfile_name = tmpfile.name
-        for kea_file in kea_files:
-            tmpfile.write(kea_file + '\n')
-
-    # Prepare the gdal_merge.py command
-    cmd = f'gdal_merge -o {output_filepath} --optfile {tmpfile_name}'
-
-    # Execute the command
-    subprocess.call(cmd, shell=True)
-
-    # Clean up the temporary file
-    os.remove(tmpfile_name)
+    mosaic_files(kea_files, output_filepath, method=method, nodata=nodata, workers=workers)
 
     print(f"Merged .kea files into: {output_filepath}")
 
@@ -41,5 +31,7 @@ if __name__ == "__main__":
     input_directory = r"C:\Users\powelj\Documents\Aotea_test_files\Landsat\dem2"
     output_directory = r"C:\Users\powelj\Documents\Aotea_test_files\Landsat\dem"
     output_filename = "merged_dem.kea"
+    method = "last"  # One of mosaic.MERGE_METHODS: first, last, min, max or mean
+    workers = 4  # Number of output windows merged in parallel
 
-    merge_kea_files(input_directory, output_directory, output_filename)
\ No newline at end of file
+    merge_kea_files(input_directory, output_directory, output_filename, method, workers=workers)
\ No newline at end of file
@@ -0,0 +1,196 @@
+"""
+Windowed in-process mosaicking. The output grid covers every input, and each output window is merged on its
+own with rasterio.merge from just the inputs overlapping it, so memory stays bounded by the window size
+rather than the mosaic size. Windows are merged on a thread pool, each thread with its own dataset handles.
+"""
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor, as_completed
+import numpy as np
+import rasterio
+from rasterio.enums import Resampling
+from rasterio.merge import merge, MERGE_METHODS as COPY_METHODS
+from rasterio.transform import from_origin
+from rasterio.windows import bounds as window_bounds
+from output_profile import get_output_meta, get_output_windows, finalize_output
+
+# How overlapping inputs are combined: the first or last valid value in input order, the minimum, maximum
+# or mean of the valid values
+MERGE_METHODS = ('first', 'last', 'min', 'max', 'mean')
+
+# Drivers for output extensions other than .tif
+OUTPUT_DRIVERS = {'.kea': 'KEA', '.img': 'HFA'}
+
+
+def get_mosaic_grid(input_files, res=None):
+    """
+    Output transform, width and height covering every input, at the first input's resolution unless res
+    (a pixel size, or (x, y) pixel sizes) is given, with the size rounded as gdal_merge does. Also returns
+    the bounds of every input and the first input's meta.
+    """
+    input_bounds = []
+    for i, input_file in enumerate(input_files):
+        with rasterio.open(input_file) as src:
+            if i == 0:
+                meta = src.meta.copy()
+            elif src.crs != meta['crs']:
+                raise ValueError(f"CRS mismatch between {input_files[0]} and {input_file}")
+            input_bounds.append(tuple(src.bounds))
+
+    res_x, res_y = (res, res) if isinstance(res, (int, float)) else res or (meta['transform'].a,
+                                                                              -meta['transform'].e)
+    left = min(b[0] for b in input_bounds)
+    bottom = min(b[1] for b in input_bounds)
+    right = max(b[2] for b in input_bounds)
+    top = max(b[3] for b in input_bounds)
+    width = int((right - left) / res_x + 0.5)
+    height = int((top - bottom) / res_y + 0.5)
+    return from_origin(left, top, res_x, res_y), width, height, input_bounds, meta
+
+
+def overlaps(a, b):
+    # Whether two (left, bottom, right, top) bounds overlap by more than an edge
+    return a[0] < b[2] and b[0] < a[2] and a[1] < b[3] and b[1] < a[3]
+
+
+def get_window_shape(bounds, res):
+    # (rows, cols) of bounds at res, rounded as rasterio.merge does
+    return int(round((bounds[3] - bounds[1]) / res[1])), int(round((bounds[2] - bounds[0]) / res[0]))
+
+
+def nodata_mask(data, nodata):
+    # Pixels of data equal to nodata, which may be NaN
+    data = np.ma.getdata(data)
+    return np.isnan(data) if np.isnan(nodata) else data == nodata
+
+
+def mask_nodata(copy, nodata=None):
+    """
+    Wrap a rasterio.merge copy function so input pixels equal to nodata are treated as invalid as well as
+    those masked by each input's own nodata value. rasterio.merge only applies the latter.
+    """
+    if nodata is None:
+        return copy
+
+    def copy_masked(merged_data, new_data, merged_mask, new_mask, **kwargs):
+        new_mask = np.ma.getmaskarray(new_data) | nodata_mask(new_data, nodata)
+        return copy(merged_data, new_data, merged_mask, new_mask, **kwargs)
+    return copy_masked
+
+
+def merge_mean(sources, bounds, res, count, nodata, dtype, resampling=Resampling.nearest, mask_value=None):
+    """
+    Mean of the valid values of the open sources over bounds, summing and counting them in a single pass
+    through rasterio.merge. Input pixels equal to mask_value, or to each input's own nodata value, are left
+    out. Pixels with no valid value are set to nodata (0 if None).
+    """
+    counts = np.zeros((count,) + get_window_shape(bounds, res), dtype='uint16')
+
+    def copy_mean(merged_data, new_data, merged_mask, new_mask, roff=0, coff=0, **kwargs):
+        # merged_data is a float64 running sum, NaN (merged_mask) where nothing has been added yet
+        valid = ~(np.ma.getmaskarray(new_data) | new_mask)
+        new_data = np.ma.getdata(new_data)
+        np.copyto(merged_data, new_data, where=merged_mask & valid, casting='unsafe')
+        np.add(merged_data, new_data, out=merged_data, where=~merged_mask & valid, casting='unsafe')
+        counts[:, roff:roff + valid.shape[1], coff:coff + valid.shape[2]] += valid
+
+    total, _ = merge(sources, bounds=bounds, res=res, nodata=np.nan, dtype='float64',
+                     method=mask_nodata(copy_mean, mask_value), resampling=resampling)
+    mean = np.divide(total, counts, out=np.zeros_like(total), where=counts > 0)
+    if np.issubdtype(np.dtype(dtype), np.integer):
+        mean = np.rint(mean)
+    mean[counts == 0] = 0 if nodata is None else nodata
+    return mean.astype(dtype)
+
+
+def merge_window(sources, bounds, res, count, method, nodata, dtype, resampling=Resampling.nearest,
+                 mask_value=None):
+    """
+    Merge the open sources over bounds with one of MERGE_METHODS, returning a (count, rows, cols) array.
+    Input pixels equal to mask_value, or to each input's own nodata value, are ignored.
+    """
+    if not sources:
+        return np.full((count,) + get_window_shape(bounds, res), 0 if nodata is None else nodata, dtype=dtype)
+    if method == 'mean':
+        return merge_mean(sources, bounds, res, count, nodata, dtype, resampling, mask_value)
+    data, _ = merge(sources, bounds=bounds, res=res, nodata=nodata, dtype=dtype,
+                    method=mask_nodata(COPY_METHODS[method], mask_value), resampling=resampling)
+    return data
+
+
+def mosaic_files(input_files, output_file, method='first', nodata=None, res=None, output_profile='default',
+                 workers=1, window_size=1024, resampling=Resampling.nearest):
+    """
+    Mosaic input_files, which must share a CRS, into output_file.
+
+    Overlaps are combined with method, one of MERGE_METHODS, where 'first' and 'last' follow the order of
+    input_files. Input pixels equal to each input's own nodata value are ignored, and so are pixels equal to
+    nodata when it is given, whether or not the inputs are tagged with it. The output takes nodata or, if
+    None, the first input's nodata. The output is written window by window (its tiles with a tiled
+    output_profile, else strips of window_size rows), each window merged from only the inputs overlapping
+    it, with up to workers windows merged at once on a thread pool. Outputs with an extension in
+    OUTPUT_DRIVERS use that driver and should keep the 'default' output profile.
+    """
+    if method not in MERGE_METHODS:
+        raise ValueError(f"Unknown merge method: {method}")
+
+    transform, width, height, input_bounds, meta = get_mosaic_grid(input_files, res)
+    res = (transform.a, -transform.e)
+    mask_value = nodata
+    nodata = meta['nodata'] if nodata is None else nodata
+    meta.update({
+        'driver': OUTPUT_DRIVERS.get(os.path.splitext(output_file)[1].lower(), 'GTiff'),
+        'transform': transform,
+        'width': width,
+        'height': height,
+        'nodata': nodata
+    })
+
+    # rasterio datasets can't be shared between threads, so each thread opens its own handles, and only to the
+    # inputs overlapping a window it merges, keeping them open for its later windows
+    local = threading.local()
+    opened = []
+    lock = threading.Lock()
+
+    def open_source(input_file):
+        if not hasattr(local, 'sources'):
+            local.sources = {}
+        src = local.sources.get(input_file)
+        if src is None:
+            src = local.sources[input_file] = rasterio.open(input_file)
+            with lock:
+                opened.append(src)
+        return src
+
+    def task(window):
+        bounds = window_bounds(window, transform)
+        sources = [open_source(input_file) for input_file, src_bounds in zip(input_files, input_bounds)
+                   if overlaps(src_bounds, bounds)]
+        return merge_window(sources, bounds, res, meta['count'], method, nodata, meta['dtype'], resampling,
+                            mask_value)
+
+    try:
+        with rasterio.open(output_file, 'w', **get_output_meta(meta, output_profile)) as dst:
+            windows = get_output_windows(dst, window_size)
+            if workers > 1:
+                # Keep about two windows per worker in flight, submitting the next as each finished one is
+                # written, so merged windows don't pile up and no worker waits on a slow neighbour
+                with ThreadPoolExecutor(max_workers=workers) as executor:
+                    pending = iter(windows)
+                    futures = {}
+                    while True:
+                        for window in pending:
+                            futures[executor.submit(task, window)] = window
+                            if len(futures) >= 2 * workers:
+                                break
+                        if not futures:
+                            break
+                        future = next(as_completed(futures))
+                        dst.write(future.result(), window=futures.pop(future))
+            else:
+                for window in windows:
+                    dst.write(task(window), window=window)
+    finally:
+        for src in opened:
+            src.close()
+    finalize_output(output_file, output_profile)
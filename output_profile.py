@@ -0,0 +1,103 @@
+import os
+import numpy as np
+import rasterio
+import rasterio.shutil
+from rasterio.enums import Resampling
+from rasterio.windows import Window
+
+# Output profiles shared by every writer. 'default' keeps the striped, uncompressed GeoTIFFs written
+# previously. The others write 512 x 512 tiles with compression and internal overviews, and 'cog' then
+# rewrites the file with a Cloud Optimized GeoTIFF layout.
+OUTPUT_PROFILES = {
+    'default': {},
+    'tiled': {'tiled': True, 'blocksize': 512, 'compress': 'deflate', 'overviews': True},
+    'zstd': {'tiled': True, 'blocksize': 512, 'compress': 'zstd', 'overviews': True},
+    'lzw': {'tiled': True, 'blocksize': 512, 'compress': 'lzw', 'overviews': True},
+    'cog': {'tiled': True, 'blocksize': 512, 'compress': 'deflate', 'overviews': True, 'cog': True},
+}
+
+# Compression methods that benefit from a predictor
+PREDICTOR_COMPRESSION = ('deflate', 'zstd', 'lzw')
+
+
+def get_profile_settings(output_profile):
+    """
+    Look up an output profile by name, or pass a dict of settings through.
+    """
+    if isinstance(output_profile, dict):
+        return output_profile
+    return OUTPUT_PROFILES[output_profile]
+
+
+def get_output_meta(meta, output_profile='default'):
+    """
+    Return a copy of a rasterio meta/profile dict with the GeoTIFF creation options for an output profile.
+    """
+    settings = get_profile_settings(output_profile)
+    meta = meta.copy()
+    if not settings:
+        return meta
+
+    meta.update(driver='GTiff', bigtiff='IF_SAFER')
+    if settings.get('tiled'):
+        meta.update(tiled=True, blockxsize=settings['blocksize'], blockysize=settings['blocksize'])
+    compress = settings.get('compress')
+    if compress:
+        meta['compress'] = compress
+        if compress in PREDICTOR_COMPRESSION:
+            # Floating point predictor for float data, horizontal differencing for integers
+            meta['predictor'] = 3 if np.issubdtype(np.dtype(meta['dtype']), np.floating) else 2
+    return meta
+
+
+def get_output_windows(dst, window_size=1024):
+    """
+    Windows to write an output in: its internal blocks if it is tiled, else strips of window_size rows.
+    """
+    if dst.profile.get('tiled'):
+        return [window for _, window in dst.block_windows(1)]
+    return [Window(0, row_off, dst.width, min(window_size, dst.height - row_off))
+            for row_off in range(0, dst.height, window_size)]
+
+
+def get_overview_levels(width, height, blocksize=512):
+    """
+    Overview decimation factors, halving until the overview fits within a single block.
+    """
+    levels = []
+    factor = 2
+    while max(width, height) / factor > blocksize / 2:
+        levels.append(factor)
+        factor *= 2
+    return levels
+
+
+def finalize_output(output_file, output_profile='default', resampling=Resampling.average):
+    """
+    Finish a file written with get_output_meta: build internal overviews in-process and, for the 'cog'
+    profile, rewrite it with a Cloud Optimized GeoTIFF layout.
+    """
+    settings = get_profile_settings(output_profile)
+    if not settings:
+        return
+
+    if settings.get('overviews'):
+        with rasterio.open(output_file, 'r+') as dst:
+            levels = get_overview_levels(dst.width, dst.height, settings.get('blocksize', 512))
+            if levels:
+                dst.build_overviews(levels, resampling)
+                dst.update_tags(ns='rio_overview', resampling=resampling.name)
+
+    if settings.get('cog'):
+        temp_file = output_file + '.cog.tmp'
+        options = {
+            'blocksize': settings.get('blocksize', 512),
+            'bigtiff': 'IF_SAFER',
+            'overviews': 'FORCE_USE_EXISTING' if settings.get('overviews') else 'NONE',
+        }
+        if settings.get('compress'):
+            options['compress'] = settings['compress']
+            if settings['compress'] in PREDICTOR_COMPRESSION:
+                options['predictor'] = 'YES'
+        rasterio.shutil.copy(output_file, temp_file, driver='COG', **options)
+        os.replace(temp_file, output_file)
@@ -0,0 +1,310 @@
+"""
+Georeferencing engine shared by the Retrolens scripts. Converts Retrolens scans with CSV metadata into GeoTIFFs
+placed at the photo centre, with the crop, rotation, offsets, CRS and pixel size given as parameters, and
+corrects their georeference afterwards by rewriting the transform or GCPs in place.
+"""
+import os
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import ExitStack
+from functools import lru_cache
+from itertools import repeat
+import numpy as np
+import pandas as pd
+import rasterio
+from rasterio.control import GroundControlPoint
+from rasterio.enums import Resampling
+from rasterio.transform import from_origin, Affine
+from rasterio.warp import calculate_default_transform, reproject
+from pyproj import Transformer
+from PIL import Image
+from output_profile import get_output_meta, get_output_windows, finalize_output
+
+
+@lru_cache(maxsize=None)
+def get_transformer(src_crs="EPSG:4326", dst_crs="EPSG:2193"):
+    """
+    Return a Transformer between two CRSs, built once per process as the PROJ database lookups are expensive.
+    """
+    return Transformer.from_crs(src_crs, dst_crs, always_xy=True)
+
+
+def convert_coordinates(lat, lon, dst_crs="EPSG:2193"):
+    easting, northing = get_transformer("EPSG:4326", dst_crs).transform(lon, lat)
+    return easting, northing
+
+
+def convert_coordinates_batch(lats, lons, dst_crs="EPSG:2193"):
+    """
+    Convert arrays of latitudes and longitudes to eastings and northings in one vectorised call.
+    """
+    eastings, northings = get_transformer("EPSG:4326", dst_crs).transform(np.asarray(lons, dtype=float),
+                                                                          np.asarray(lats, dtype=float))
+    return eastings, northings
+
+
+def find_image_pairs(input_dir):
+    """
+    List the (filename, image path, CSV path) of each Retrolens .jpg in input_dir that has a metadata CSV.
+    """
+    pairs = []
+    for filename in os.listdir(input_dir):
+        if filename.endswith(".jpg"):
+            csv_filename = filename.replace("Crown_", "").replace(".jpg", ".csv")
+            csv_path = os.path.join(input_dir, csv_filename)
+            if os.path.exists(csv_path):
+                pairs.append((filename, os.path.join(input_dir, filename), csv_path))
+    return pairs
+
+
+def read_photo_centres(csv_paths, lat_offset=0.0, lon_offset=0.0, dst_crs="EPSG:2193"):
+    """
+    Read the metadata CSV of every frame and convert all the photo centres, shifted by the lat/lon offsets, in
+    a single transform call. Returns the metadata DataFrames, with the exception raised in place of any CSV
+    that could not be read, and arrays of eastings and northings (NaN for those frames).
+    """
+    metadata = []
+    lats = np.full(len(csv_paths), np.nan)
+    lons = np.full(len(csv_paths), np.nan)
+    for i, csv_path in enumerate(csv_paths):
+        try:
+            frame = pd.read_csv(csv_path, header=0)
+            lats[i] = lat_offset + float(frame.at[0, 'Photo_Centre_Lat'])
+            lons[i] = lon_offset + float(frame.at[0, 'Photo_Centre_Long'])
+            metadata.append(frame)
+        except Exception as e:
+            metadata.append(e)
+
+    eastings, northings = convert_coordinates_batch(lats, lons, dst_crs)
+    return metadata, eastings, northings
+
+
+def georeference_frame(image_path, metadata, easting, northing, output_dir, rotation_correction=0, crop=None,
+                       rotate=0, dst_crs="EPSG:2193", ground_distance=None, output_profile='default',
+                       output_prefix='', draft=1):
+    """
+    Write one scan as a GeoTIFF with its top left corner at the photo centre and return the output file name.
+
+    crop is the (left, top, right, bottom) margin in pixels trimmed from each edge, and rotate an angle in
+    degrees counter-clockwise (as PIL's Image.rotate) applied to the pixels. The pixel size is ground_distance,
+    or the frame's Altitude if None, divided by its Scale. rotation_correction rotates the transform about
+    the image centre; like the original scripts it goes through np.deg2rad before Affine.rotation, which
+    takes degrees, so existing angles (5156.5 for 90 degrees) still apply.
+
+    draft of 2, 4 or 8 decodes JPEG scans at that fraction of their resolution through PIL's draft mode, for
+    quick preview runs; the crop margins and pixel size are scaled to match so the frame covers the same area.
+    """
+    altitude = float(metadata.at[0, 'Altitude'])
+    scale = float(metadata.at[0, 'Scale'])
+    date = str(metadata.at[0, 'Date'])
+    image_name = str(metadata.at[0, 'Name'])
+
+    # Open the image, decoding JPEGs at a reduced scale in draft mode
+    img = Image.open(image_path)
+    full_width = img.size[0]
+    if draft > 1:
+        img.draft(img.mode, (img.size[0] // draft, img.size[1] // draft))
+    reduction = full_width / img.size[0]
+
+    if rotate % 90 == 0:
+        # Decode once, then crop and rotate by multiples of 90 degrees as numpy views of the decoded frame
+        img_array = np.asarray(img)
+        if crop is not None:
+            left, top, right, bottom = (int(round(margin / reduction)) for margin in crop)
+            img_array = img_array[top:img_array.shape[0] - bottom, left:img_array.shape[1] - right]
+        img_array = np.rot90(img_array, int(rotate // 90) % 4)
+    else:
+        # Crop the image
+        if crop is not None:
+            width, height = img.size
+            left, top, right, bottom = (int(round(margin / reduction)) for margin in crop)
+            img = img.crop((left, top, width - right, height - bottom))
+
+        # Rotate the image
+        img = img.rotate(rotate, expand=True)
+        img_array = np.asarray(img)
+
+    # View as (bands, rows, cols)
+    bands = img_array[np.newaxis] if img_array.ndim == 2 else img_array.transpose(2, 0, 1)[:3]
+    height, width = bands.shape[1:]
+
+    # Calculate the new transform
+    pixel_size = (altitude if ground_distance is None else ground_distance) / scale * reduction
+    transform = from_origin(easting, northing, pixel_size, pixel_size)
+
+    # Apply rotation correction, with the centre as rotation point
+    rotation_correction_rad = np.deg2rad(rotation_correction)
+    new_transform = transform * Affine.rotation(rotation_correction_rad, (width / 2, height / 2))
+
+    # Define the metadata
+    meta = {
+        'driver': 'GTiff',
+        'height': bands.shape[1],
+        'width': bands.shape[2],
+        'count': bands.shape[0],
+        'dtype': bands.dtype,
+        'crs': dst_crs,
+        'transform': new_transform
+    }
+
+    output_filename = f"{output_prefix}{image_name}_{date}.tif"
+    output_path = os.path.join(output_dir, output_filename)
+
+    # Save as GeoTIFF, writing every band and all the CSV columns as tags at once
+    tags = {key: str(value) for key, value in metadata.iloc[0].items() if pd.notnull(value)}
+    with rasterio.open(output_path, 'w', **get_output_meta(meta, output_profile)) as dst:
+        dst.write(bands)
+        dst.update_tags(**tags)
+    finalize_output(output_path, output_profile)
+    return output_filename
+
+
+def georeference_task(args, options):
+    # Run georeference_frame, returning (output file name, None) or (None, exception) so one bad frame doesn't
+    # stop the batch
+    try:
+        return georeference_frame(*args, **options), None
+    except Exception as e:
+        return None, e
+
+
+def process_images(input_dir, output_dir, rotation_correction=0, crop=None, rotate=0, lat_offset=0.0,
+                   lon_offset=0.0, dst_crs="EPSG:2193", ground_distance=None, output_profile='default',
+                   output_prefix='', draft=1, workers=1):
+    """
+    Georeference every Retrolens scan in input_dir that has a metadata CSV, see georeference_frame for the
+    options. The photo centres are shifted by the lat/lon offsets and converted to dst_crs in one batch, and
+    with workers > 1 the frames are processed on a process pool. Returns the paths written.
+    """
+    if not os.path.exists(output_dir):
+        os.makedirs(output_dir)
+
+    # Read every frame's CSV and convert all photo centres from EPSG:4326 in one call
+    pairs = find_image_pairs(input_dir)
+    all_metadata, eastings, northings = read_photo_centres([csv_path for _, _, csv_path in pairs], lat_offset,
+                                                           lon_offset, dst_crs)
+    options = dict(rotation_correction=rotation_correction, crop=crop, rotate=rotate, dst_crs=dst_crs,
+                   ground_distance=ground_distance, output_profile=output_profile, output_prefix=output_prefix,
+                   draft=draft)
+
+    jobs = []
+    for (filename, image_path, csv_path), metadata, easting, northing in zip(pairs, all_metadata, eastings,
+                                                                             northings):
+        if isinstance(metadata, Exception):
+            print(f"Failed to process {filename}: {metadata}")
+            continue
+        jobs.append((filename, (image_path, metadata, easting, northing, output_dir)))
+
+    output_paths = []
+    with ExitStack() as stack:
+        if workers > 1:
+            executor = stack.enter_context(ProcessPoolExecutor(max_workers=workers))
+            results = executor.map(georeference_task, [args for _, args in jobs], repeat(options))
+        else:
+            results = (georeference_task(args, options) for _, args in jobs)
+
+        for (filename, _), (output_filename, error) in zip(jobs, results):
+            if error is not None:
+                print(f"Failed to process {filename}: {error}")
+                continue
+            output_paths.append(os.path.join(output_dir, output_filename))
+            print(f"Processed {filename} to {output_filename}")
+    return output_paths
+
+
+def get_correction(angle=0, shift_x=0, shift_y=0, scale=1, pivot=None):
+    """
+    Affine correction in pixel space: rotate by angle degrees counter-clockwise about pivot (a (col, row)
+    pixel position, the top left corner if None), then shift by shift_x pixels right and shift_y pixels up and
+    scale the pixel size by scale. As in Retrolens_trial.rotate_raster, it is applied as transform * correction.
+    """
+    return Affine.rotation(angle, pivot) * Affine.translation(shift_x, -shift_y) * Affine.scale(scale)
+
+
+def correct_georeference(path, angle=0, shift_x=0, shift_y=0, scale=1, pivot='centre'):
+    """
+    Apply a rotation, shift and scale correction (see get_correction) to a georeferenced raster by rewriting
+    its transform, or its GCPs if it is georeferenced by GCPs, in place. No pixels are read or written, so
+    trying another angle on a frame takes milliseconds. pivot='centre' rotates about the raster centre.
+    Returns the new transform, or the new GCPs.
+    """
+    with rasterio.open(path, 'r+') as dst:
+        if pivot == 'centre':
+            pivot = (dst.width / 2, dst.height / 2)
+        correction = get_correction(angle, shift_x, shift_y, scale, pivot)
+
+        gcps, gcp_crs = dst.gcps
+        if gcps:
+            # A GCP keeps its ground position and moves to the pixel the corrected transform would map there
+            inverse = ~correction
+            corrected = []
+            for gcp in gcps:
+                col, row = inverse * (gcp.col, gcp.row)
+                corrected.append(GroundControlPoint(row, col, gcp.x, gcp.y, gcp.z, gcp.id, gcp.info))
+            dst.gcps = (corrected, gcp_crs)
+            return corrected
+
+        dst.transform = dst.transform * correction
+        return dst.transform
+
+
+def get_north_up_grid(src, dst_crs=None):
+    # Output transform, width and height covering src (rotated, or georeferenced by GCPs) on a north-up grid
+    dst_crs = dst_crs or src.crs or src.gcps[1]
+    gcps, gcp_crs = src.gcps
+    if gcps:
+        return calculate_default_transform(gcp_crs, dst_crs, src.width, src.height, gcps=gcps)
+    if dst_crs != src.crs:
+        left, bottom, right, top = src.bounds
+        return calculate_default_transform(src.crs, dst_crs, src.width, src.height, left, bottom, right, top)
+
+    # Same CRS: keep the pixel size and take the bounding box of the rotated corners
+    t = src.transform
+    xs, ys = zip(*(t * corner for corner in [(0, 0), (src.width, 0), (0, src.height), (src.width, src.height)]))
+    res = (abs(t.a * t.e - t.b * t.d)) ** 0.5
+    width = int(np.ceil((max(xs) - min(xs)) / res))
+    height = int(np.ceil((max(ys) - min(ys)) / res))
+    return from_origin(min(xs), max(ys), res, res), width, height
+
+
+def warp_north_up(input_path, output_path, dst_crs=None, resampling=Resampling.bilinear, nodata=0,
+                  output_profile='default', num_threads=1, warp_mem_limit=0, window_size=1024):
+    """
+    Resample a rotated or GCP-georeferenced raster onto a north-up grid, in its own CRS unless dst_crs is
+    given. Deferred until a north-up product is actually needed; all bands are warped together straight from
+    the source dataset one output window at a time, using num_threads threads and up to warp_mem_limit MB of
+    warp memory (0 for GDAL's default).
+    """
+    with rasterio.open(input_path) as src:
+        gcps, gcp_crs = src.gcps
+        dst_crs = dst_crs or src.crs or gcp_crs
+        transform, width, height = get_north_up_grid(src, dst_crs)
+        dst_nodata = src.nodata if src.nodata is not None else nodata
+        meta = src.meta.copy()
+        meta.update({
+            'driver': 'GTiff',
+            'crs': dst_crs,
+            'transform': transform,
+            'width': width,
+            'height': height,
+            'nodata': dst_nodata
+        })
+        bands = list(range(1, src.count + 1))
+        georeference = {'gcps': gcps, 'src_crs': gcp_crs} if gcps else {}
+
+        with rasterio.open(output_path, 'w', **get_output_meta(meta, output_profile)) as dst:
+            dst.update_tags(**src.tags())
+            for window in get_output_windows(dst, window_size):
+                data = np.full((src.count, int(window.height), int(window.width)), dst_nodata, dtype=src.dtypes[0])
+                reproject(
+                    source=rasterio.band(src, bands),
+                    destination=data,
+                    dst_transform=dst.window_transform(window),
+                    dst_crs=dst_crs,
+                    dst_nodata=dst_nodata,
+                    resampling=resampling,
+                    num_threads=num_threads,
+                    warp_mem_limit=warp_mem_limit,
+                    **georeference
+                )
+                dst.write(data, window=window)
+    finalize_output(output_path, output_profile)
@@ -0,0 +1,333 @@
+"""
+Automatic georeferencing of Retrolens frames against a reference raster, such as a Sentinel composite or
+Landsat stack produced by this project. ORB keypoints of a downscaled frame are matched with those of the
+reference around the frame's rough footprint, an affine or projective transform is estimated with RANSAC,
+and GCPs derived from it are written into the frame. Matching runs coarse to fine over pyramid levels, and
+the reference descriptors are cached per tile so frames of one flight line reuse them.
+"""
+import os
+import threading
+from concurrent.futures import Future, ProcessPoolExecutor
+from itertools import repeat
+import numpy as np
+import rasterio
+from rasterio.control import GroundControlPoint
+from rasterio.enums import Resampling
+from rasterio.transform import Affine
+from rasterio.warp import transform as warp_transform
+from rasterio.windows import Window, from_bounds
+from skimage.feature import ORB, match_descriptors
+from skimage.measure import ransac
+from skimage.transform import AffineTransform, ProjectiveTransform
+from file_utils import file_signature
+
+MODELS = {
+    'affine': (AffineTransform, 3),
+    'projective': (ProjectiveTransform, 4),
+}
+
+
+def to_gray(data, nodata=None):
+    # Average the bands and stretch the 2nd-98th percentile of the valid pixels to 0-1, with nodata at 0
+    data = np.asarray(data, dtype='float32')
+    valid = np.ones(data.shape[1:], dtype=bool) if nodata is None else np.all(data != nodata, axis=0)
+    gray = data.mean(axis=0)
+    if not valid.any():
+        return np.zeros(gray.shape, dtype='float32')
+    low, high = np.percentile(gray[valid], (2, 98))
+    gray = np.clip((gray - low) / max(high - low, 1e-6), 0, 1)
+    gray[~valid] = 0
+    return gray
+
+
+def detect_features(image, n_keypoints=500, fast_threshold=0.05):
+    """
+    ORB keypoints as (row, col) positions and their binary descriptors; empty arrays when the image has too
+    little texture or is too small.
+    """
+    orb = ORB(n_keypoints=n_keypoints, fast_threshold=fast_threshold)
+    try:
+        orb.detect_and_extract(image)
+    except RuntimeError:
+        return np.empty((0, 2)), np.empty((0, 256), dtype=bool)
+    return orb.keypoints, orb.descriptors
+
+
+def get_frame_corners(src):
+    # Map coordinates of the four corners of a frame, from its GCPs if it has them, else its transform
+    corners = [(0, 0), (src.width, 0), (0, src.height), (src.width, src.height)]
+    gcps, gcp_crs = src.gcps
+    if gcps:
+        model = AffineTransform()
+        model.estimate(np.array([(gcp.col, gcp.row) for gcp in gcps]), np.array([(gcp.x, gcp.y) for gcp in gcps]))
+        return model(np.array(corners, dtype=float)), gcp_crs
+    return np.array([src.transform * corner for corner in corners]), src.crs
+
+
+class ReferenceIndex:
+    """
+    Reference raster split into tiles of tile_size pixels at each pyramid level, with the ORB features of
+    every tile computed once and kept in memory, and in cache_dir as .npz files if given, keyed by the
+    reference's mtime and size, tile_size, bands and n_keypoints. Features are stored in the reference CRS so
+    tiles are shared by every frame that overlaps them.
+    """
+
+    def __init__(self, reference_path, bands=None, tile_size=512, n_keypoints=500, cache_dir=None):
+        self.reference_path = reference_path
+        self.tile_size = tile_size
+        self.n_keypoints = n_keypoints
+        self.cache_dir = cache_dir
+        self._tiles = {}
+        self._lock = threading.Lock()
+        with rasterio.open(reference_path) as src:
+            self.crs = src.crs
+            self.transform = src.transform
+            self.width, self.height = src.width, src.height
+            self.nodata = src.nodata
+            self.bands = list(bands) if bands else [1] if src.count < 3 else [1, 2, 3]
+        self.resolution = abs(self.transform.a)
+        self.signature = file_signature(reference_path) + [tile_size, n_keypoints] + self.bands
+        if cache_dir and not os.path.exists(cache_dir):
+            os.makedirs(cache_dir)
+
+    def tile_features(self, level, tile_row, tile_col):
+        """
+        Map coordinates (x, y) and descriptors of the ORB keypoints in one tile at a pyramid level (a
+        decimation factor of the reference resolution).
+        """
+        # The lock only guards the dict: the first thread to ask for a tile computes it outside the lock, and
+        # other threads asking for the same tile wait on its future
+        key = (level, tile_row, tile_col)
+        with self._lock:
+            tile = self._tiles.get(key)
+            owner = tile is None
+            if owner:
+                tile = self._tiles[key] = Future()
+
+        if owner:
+            try:
+                tile.set_result(self._load_tile(*key))
+            except Exception as e:
+                # Let a later call retry the tile
+                with self._lock:
+                    del self._tiles[key]
+                tile.set_exception(e)
+        return tile.result()
+
+    def _load_tile(self, level, tile_row, tile_col):
+        cache_path = None
+        if self.cache_dir:
+            # Tiles computed with another tile size, band set or keypoint count cover different features
+            name = os.path.splitext(os.path.basename(self.reference_path))[0]
+            settings = f"T{self.tile_size}_B{'-'.join(map(str, self.bands))}_K{self.n_keypoints}"
+            cache_path = os.path.join(self.cache_dir, f"{name}_{settings}_L{level}_{tile_row}_{tile_col}.npz")
+            if os.path.exists(cache_path):
+                cached = np.load(cache_path)
+                if tuple(cached['signature']) == tuple(self.signature):
+                    return cached['coords'], cached['descriptors']
+
+        # Read the tile with a margin so keypoints near its edges are still detected, then keep those inside
+        size = self.tile_size * level
+        pad = 32 * level
+        window = Window(tile_col * size - pad, tile_row * size - pad, size + 2 * pad, size + 2 * pad)
+        out_shape = (len(self.bands), self.tile_size + 64, self.tile_size + 64)
+        with rasterio.open(self.reference_path) as src:
+            data = src.read(self.bands, window=window, out_shape=out_shape, boundless=True,
+                            fill_value=self.nodata or 0, resampling=Resampling.average)
+            tile_transform = src.window_transform(window) * Affine.scale(level)
+        keypoints, descriptors = detect_features(to_gray(data, self.nodata or 0), self.n_keypoints)
+        inside = np.all((keypoints >= 32) & (keypoints < self.tile_size + 32), axis=1)
+        keypoints, descriptors = keypoints[inside], descriptors[inside]
+        coords = np.array([tile_transform * (col + 0.5, row + 0.5) for row, col in keypoints]).reshape(-1, 2)
+
+        if cache_path:
+            # Write then rename, so worker processes sharing cache_dir never load a half-written file
+            temp_path = f"{cache_path}.{os.getpid()}.tmp"
+            with open(temp_path, 'wb') as f:
+                np.savez(f, signature=np.array(self.signature), coords=coords, descriptors=descriptors)
+            os.replace(temp_path, cache_path)
+        return coords, descriptors
+
+    def features(self, bounds, level):
+        """
+        Map coordinates and descriptors of the reference keypoints of every tile overlapping bounds
+        (left, bottom, right, top in the reference CRS) at a pyramid level.
+        """
+        window = from_bounds(*bounds, transform=self.transform)
+        size = self.tile_size * level
+        first_row = max(int(window.row_off // size), 0)
+        last_row = min(int((window.row_off + window.height) // size), (self.height - 1) // size)
+        first_col = max(int(window.col_off // size), 0)
+        last_col = min(int((window.col_off + window.width) // size), (self.width - 1) // size)
+
+        coords, descriptors = [np.empty((0, 2))], [np.empty((0, 256), dtype=bool)]
+        for tile_row in range(first_row, last_row + 1):
+            for tile_col in range(first_col, last_col + 1):
+                tile_coords, tile_descriptors = self.tile_features(level, tile_row, tile_col)
+                coords.append(tile_coords)
+                descriptors.append(tile_descriptors)
+        return np.concatenate(coords), np.concatenate(descriptors)
+
+
+def match_frame(frame_path, reference, levels=(4, 2, 1), model='affine', search_margin=0.5, min_inliers=12,
+                max_ratio=0.8, max_trials=2000):
+    """
+    Estimate the transform from a frame's full resolution pixel (col, row) to reference map coordinates.
+
+    At each pyramid level the frame is read at reference resolution times the level and matched against the
+    reference tiles around its footprint: the rough footprint from its current georeference, grown by
+    search_margin times its size, at the first level, then the footprint found at the previous level.
+    Returns (model, number of inliers) from the finest level that found at least min_inliers, or None.
+    """
+    model_class, min_samples = MODELS[model]
+    with rasterio.open(frame_path) as src:
+        # Corners in the reference CRS, so the frame's pixel size is in the same units as the reference's
+        corners, frame_crs = get_frame_corners(src)
+        corners = np.column_stack(warp_transform(frame_crs, reference.crs, corners[:, 0], corners[:, 1]))
+        frame_resolution = np.hypot(*(corners[1] - corners[0])) / src.width
+        frame_size = (src.width, src.height)
+        frame_nodata = src.nodata
+
+        # Rough footprint, widened to allow for the error of the initial georeference
+        left, bottom = corners.min(axis=0)
+        right, top = corners.max(axis=0)
+        margin = search_margin * max(right - left, top - bottom)
+        bounds = (left - margin, bottom - margin, right + margin, top + margin)
+
+        result = None
+        for level in levels:
+            # Frame at the level's ground resolution, keypoints scaled back to full resolution pixels
+            factor = reference.resolution * level / frame_resolution
+            out_shape = (src.count, max(int(src.height / factor), 1), max(int(src.width / factor), 1))
+            data = src.read(out_shape=out_shape, resampling=Resampling.average)
+            keypoints, frame_descriptors = detect_features(to_gray(data, frame_nodata), reference.n_keypoints)
+            frame_pixels = (keypoints[:, ::-1] + 0.5) * (src.width / out_shape[2], src.height / out_shape[1])
+
+            ref_coords, ref_descriptors = reference.features(bounds, level)
+            if len(frame_pixels) < min_samples or len(ref_coords) < min_samples:
+                continue
+            matches = match_descriptors(frame_descriptors, ref_descriptors, cross_check=True, max_ratio=max_ratio)
+            if len(matches) < min_samples:
+                continue
+
+            # Estimate about the footprint centre to keep the map coordinates well conditioned
+            origin = np.array([(bounds[0] + bounds[2]) / 2, (bounds[1] + bounds[3]) / 2])
+            estimate, inliers = ransac((frame_pixels[matches[:, 0]], ref_coords[matches[:, 1]] - origin),
+                                       model_class, min_samples=min_samples,
+                                       residual_threshold=2 * reference.resolution * level, max_trials=max_trials,
+                                       rng=0)
+            if estimate is None or inliers is None or inliers.sum() < min_inliers:
+                continue
+            result = (ShiftedTransform(estimate, origin), int(inliers.sum()))
+
+            # Search the next level only around the footprint found here
+            found = result[0](np.array([(0, 0), (frame_size[0], 0), (0, frame_size[1]), frame_size], dtype=float))
+            margin = 8 * reference.resolution * level
+            bounds = (found[:, 0].min() - margin, found[:, 1].min() - margin,
+                      found[:, 0].max() + margin, found[:, 1].max() + margin)
+    return result
+
+
+class ShiftedTransform:
+    """
+    A scikit-image transform estimated about an origin, mapping pixel (col, row) to map (x, y) coordinates.
+    """
+
+    def __init__(self, model, origin):
+        self.model = model
+        self.origin = origin
+
+    def __call__(self, pixels):
+        return self.model(np.asarray(pixels, dtype=float)) + self.origin
+
+
+def write_gcps(frame_path, transform, crs, grid=4):
+    """
+    Write a grid x grid lattice of GCPs mapping frame pixels through transform into the frame, in place.
+    """
+    with rasterio.open(frame_path, 'r+') as dst:
+        cols = np.linspace(0, dst.width, grid)
+        rows = np.linspace(0, dst.height, grid)
+        pixels = np.array([(col, row) for row in rows for col in cols])
+        gcps = [GroundControlPoint(row, col, x, y, id=str(i))
+                for i, ((col, row), (x, y)) in enumerate(zip(pixels, transform(pixels)))]
+        dst.gcps = (gcps, crs)
+    return gcps
+
+
+def georeference_frame_gcps(frame_path, reference, grid=4, **options):
+    """
+    Match one frame against the reference and write its GCPs. Returns the number of RANSAC inliers, or None
+    if no level matched, in which case the frame is left unchanged.
+    """
+    result = match_frame(frame_path, reference, **options)
+    if result is None:
+        return None
+    transform, inliers = result
+    write_gcps(frame_path, transform, reference.crs, grid)
+    return inliers
+
+
+def try_georeference_frame(frame_path, reference, grid, options):
+    # georeference_frame_gcps, reporting a failure and returning None instead of raising
+    try:
+        return georeference_frame_gcps(frame_path, reference, grid, **options)
+    except Exception as e:
+        print(f"Failed to georeference {frame_path}: {e}")
+        return None
+
+
+# Reference indexes built by a worker process, kept between the frames it matches
+_worker_references = {}
+
+
+def _georeference_frame_task(frame_path, reference_args, grid, options):
+    """
+    Worker task georeferencing one frame against this process's own ReferenceIndex.
+    """
+    if reference_args not in _worker_references:
+        reference_path, reference_bands, cache_dir = reference_args
+        _worker_references[reference_args] = ReferenceIndex(reference_path, reference_bands, cache_dir=cache_dir)
+    return try_georeference_frame(frame_path, _worker_references[reference_args], grid, options)
+
+
+def georeference_frames(input_dir, reference_path, reference_bands=None, workers=1, cache_dir=None, grid=4,
+                        **options):
+    """
+    Georeference every .tif frame in input_dir (e.g. the output of retrolens.process_images) against the
+    reference raster, so overlapping frames reuse the reference's tile descriptors. ORB detection and
+    matching are CPU bound, so with workers > 1 frames are matched on a process pool, each worker keeping its
+    own ReferenceIndex; give cache_dir so workers also share the tiles computed by the others. Returns
+    {frame path: inliers or None}.
+    """
+    reference_args = (reference_path, tuple(reference_bands) if reference_bands else None, cache_dir)
+    frame_paths = sorted(os.path.join(input_dir, f) for f in os.listdir(input_dir) if f.endswith('.tif'))
+
+    if workers > 1:
+        # Hand each worker runs of consecutive frames, which in a flight line overlap the same reference tiles
+        chunksize = max(1, len(frame_paths) // (4 * workers))
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            inliers = executor.map(_georeference_frame_task, frame_paths, repeat(reference_args), repeat(grid),
+                                   repeat(options), chunksize=chunksize)
+            results = dict(zip(frame_paths, inliers))
+    else:
+        reference = ReferenceIndex(reference_path, reference_bands, cache_dir=cache_dir)
+        results = {frame_path: try_georeference_frame(frame_path, reference, grid, options)
+                   for frame_path in frame_paths}
+
+    for frame_path, inliers in results.items():
+        if inliers is None:
+            print(f"No match for {frame_path}, left unchanged")
+        else:
+            print(f"Wrote GCPs to {frame_path} from {inliers} inliers")
+    return results
+
+
+if __name__ == "__main__":
+    input_directory = r"C:\Users\powelj\Documents\Aotea_test_files\Retrolens\Outputs"
+    reference_raster = r"C:\Users\powelj\Documents\Aotea_test_files\Sentinel2\stacked\S2_composite.tif"
+    reference_bands = (2, 3, 4)  # Visible bands of the reference, e.g. B02, B03 and B04 of a Sentinel 2 stack
+    cache_directory = r"C:\Users\powelj\Documents\Aotea_test_files\Retrolens\descriptor_cache"
+    workers = 4
+    georeference_frames(input_directory, reference_raster, reference_bands, workers=workers,
+                        cache_dir=cache_directory, levels=(4, 2, 1), model='affine')
@@ -0,0 +1,168 @@
+import os
+import re
+import json
+import sqlite3
+from datetime import datetime
+import rasterio
+from rasterio.crs import CRS
+from rasterio.transform import Affine
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS scenes (
+    path TEXT PRIMARY KEY,
+    mtime REAL NOT NULL,
+    size INTEGER NOT NULL,
+    driver TEXT,
+    crs TEXT,
+    transform TEXT,
+    width INTEGER,
+    height INTEGER,
+    count INTEGER,
+    dtype TEXT,
+    nodata TEXT,
+    bounds TEXT,
+    acquisition_date TEXT
+);
+CREATE TABLE IF NOT EXISTS directories (
+    path TEXT PRIMARY KEY,
+    mtime REAL NOT NULL,
+    subdirs TEXT NOT NULL,
+    files TEXT NOT NULL
+);
+"""
+
+# Bumped when the scenes table changes; older indexes have their scenes re-read. Version 1 stores nodata as
+# JSON text, as a REAL column turns a NaN nodata value into NULL.
+SCHEMA_VERSION = 1
+
+# First standalone 8 digit group in a file name, e.g. SEN2_20231224_... or LT04_L1TP_073085_19901216_...
+DATE_PATTERN = re.compile(r'(?<!\d)(\d{8})(?!\d)')
+
+
+def parse_acquisition_date(filename):
+    """
+    Parse the acquisition date (YYYY-MM-DD) from an ARCSI, Sentinel or Landsat file name, or None.
+    """
+    for match in DATE_PATTERN.finditer(os.path.basename(filename)):
+        try:
+            return datetime.strptime(match.group(1), "%Y%m%d").date().isoformat()
+        except ValueError:
+            continue
+    return None
+
+
+class SceneIndex:
+    """
+    On-disk SQLite cache of raster metadata (profile, bounds, band count, nodata and acquisition date) and
+    directory listings, so repeated runs over a large archive query the index instead of walking the tree
+    and opening every file.
+
+    Scenes are keyed by path, mtime and size and re-read only when the file changes. Directory listings are
+    reused while the directory's mtime is unchanged, which holds when files are added, removed or renamed.
+    """
+
+    def __init__(self, db_path, commit_every=100):
+        self.conn = sqlite3.connect(db_path, timeout=60)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        if self.conn.execute("PRAGMA user_version").fetchone()[0] < SCHEMA_VERSION:
+            self.conn.execute("DROP TABLE IF EXISTS scenes")
+            self.conn.execute(f"PRAGMA user_version = {SCHEMA_VERSION}")
+        self.conn.executescript(SCHEMA)
+        self.commit_every = commit_every
+        self._pending = 0
+        self._crs_cache = {}
+
+    def commit(self):
+        self.conn.commit()
+        self._pending = 0
+
+    def close(self):
+        self.commit()
+        self.conn.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def list_directory(self, folder):
+        """
+        Return the subdirectories and file names of a folder, from the index if the folder is unchanged.
+        """
+        mtime = os.stat(folder).st_mtime
+        row = self.conn.execute("SELECT mtime, subdirs, files FROM directories WHERE path = ?",
+                                (folder,)).fetchone()
+        if row is not None and row[0] == mtime:
+            return json.loads(row[1]), json.loads(row[2])
+
+        subdirs = []
+        files = []
+        with os.scandir(folder) as entries:
+            for entry in entries:
+                if entry.is_dir():
+                    subdirs.append(entry.name)
+                else:
+                    files.append(entry.name)
+        self.conn.execute("INSERT OR REPLACE INTO directories VALUES (?, ?, ?, ?)",
+                          (folder, mtime, json.dumps(subdirs), json.dumps(files)))
+        self._written()
+        return subdirs, files
+
+    def list_files(self, folder, file_suffix):
+        """
+        Retrieve all files with the specified suffix below a folder, in the same order as os.walk.
+        """
+        image_files = []
+        folders = [folder]
+        while folders:
+            root = folders.pop(0)
+            subdirs, files = self.list_directory(root)
+            for file in files:
+                if file.endswith(file_suffix):
+                    image_files.append(os.path.join(root, file))
+            folders[0:0] = [os.path.join(root, d) for d in subdirs]
+        self.commit()
+        return image_files
+
+    def get_scene(self, path):
+        """
+        Return the indexed metadata for a raster, opening it only if it is new or has changed since it was
+        indexed. The profile values 'crs' and 'transform' are returned as rasterio objects.
+        """
+        stat = os.stat(path)
+        row = self.conn.execute("SELECT * FROM scenes WHERE path = ? AND mtime = ? AND size = ?",
+                                (path, stat.st_mtime, stat.st_size)).fetchone()
+        if row is None:
+            row = self._index_scene(path, stat)
+
+        columns = ['path', 'mtime', 'size', 'driver', 'crs', 'transform', 'width', 'height', 'count', 'dtype',
+                   'nodata', 'bounds', 'acquisition_date']
+        scene = dict(zip(columns, row))
+        scene['crs'] = self._get_crs(scene['crs'])
+        scene['transform'] = Affine(*json.loads(scene['transform']))
+        scene['bounds'] = tuple(json.loads(scene['bounds']))
+        scene['nodata'] = json.loads(scene['nodata'])
+        return scene
+
+    def _index_scene(self, path, stat):
+        with rasterio.open(path) as src:
+            row = (path, stat.st_mtime, stat.st_size, src.driver, src.crs.to_wkt() if src.crs else None,
+                   json.dumps(list(src.transform)[:6]), src.width, src.height, src.count, src.dtypes[0],
+                   json.dumps(src.nodata), json.dumps(list(src.bounds)), parse_acquisition_date(path))
+        self.conn.execute("INSERT OR REPLACE INTO scenes VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)", row)
+        self._written()
+        return row
+
+    def _get_crs(self, wkt):
+        if not wkt:
+            return None
+        if wkt not in self._crs_cache:
+            self._crs_cache[wkt] = CRS.from_wkt(wkt)
+        return self._crs_cache[wkt]
+
+    def _written(self):
+        # Commit in batches so other processes sharing the index aren't locked out for long
+        self._pending += 1
+        if self._pending >= self.commit_every:
+            self.commit()
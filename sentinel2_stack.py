@@ -0,0 +1,131 @@
+import os
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from glob import glob
+from rasterio.enums import Resampling
+from tqdm import tqdm
+from extract import BAND_PATTERN, MANIFEST_NAME, read_safe_manifest
+from vrt_stack import build_stack_vrt, materialize_vrt
+
+# The 13 Sentinel-2 MSI bands in stacking order. L2A products have no B10.
+SENTINEL2_BANDS = ['B01', 'B02', 'B03', 'B04', 'B05', 'B06', 'B07', 'B08', 'B8A', 'B09', 'B10', 'B11', 'B12']
+
+
+def find_safe_products(input_dir):
+    """
+    Find the .SAFE products below input_dir, including any registered in place by extract.py's manifest mode.
+    """
+    safe_dirs = []
+    for root, dirs, files in os.walk(input_dir):
+        for dir_name in dirs:
+            if dir_name.endswith('.SAFE'):
+                safe_dirs.append(os.path.join(root, dir_name))
+        dirs[:] = [d for d in dirs if not d.endswith('.SAFE')]
+
+    manifest_path = os.path.join(input_dir, MANIFEST_NAME)
+    if os.path.exists(manifest_path):
+        safe_dirs.extend(path for path in read_safe_manifest(input_dir).values() if path not in safe_dirs)
+    return sorted(safe_dirs)
+
+
+def find_granule_bands(safe_dir):
+    """
+    Map each granule of a SAFE product to its band files, {granule: {band: path}}. L2A products hold bands at
+    several resolutions (R10m, R20m, R60m); the finest available version of each band is used.
+    """
+    granules = {}
+    for granule_dir in sorted(glob(os.path.join(safe_dir, 'GRANULE', '*'))):
+        band_files = {}
+        band_resolutions = {}
+        for root, dirs, files in os.walk(os.path.join(granule_dir, 'IMG_DATA')):
+            for file in files:
+                match = BAND_PATTERN.search(file)
+                if match is None or match.group(1) not in SENTINEL2_BANDS:
+                    continue
+                band = match.group(1)
+                resolution = int(match.group(2)[1:-1]) if match.group(2) else 0
+                if band not in band_files or resolution < band_resolutions[band]:
+                    band_files[band] = os.path.join(root, file)
+                    band_resolutions[band] = resolution
+        if band_files:
+            granules[os.path.basename(granule_dir)] = band_files
+    return granules
+
+
+def stack_granule(band_files, output_file, bands=None, resolution=10, resampling=Resampling.bilinear,
+                  output_profile='default', mode='tiff'):
+    """
+    Stack a granule's bands at the target resolution. The 20 m and 60 m bands are resampled by the virtual
+    stack as each window is read, so no band is ever read whole at its own or the target resolution.
+
+    mode='tiff' streams the stack into a GeoTIFF, mode='vrt' writes only a VRT referencing the .jp2 files.
+    """
+    bands = [band for band in (bands or SENTINEL2_BANDS) if band in band_files]
+    files = [band_files[band] for band in bands]
+    if mode == 'vrt':
+        build_stack_vrt([os.path.abspath(f) for f in files], output_file, resampling, bands, resolution)
+    elif mode == 'tiff':
+        materialize_vrt(build_stack_vrt(files, None, resampling, bands, resolution), output_file, output_profile)
+    else:
+        raise ValueError(f"Unknown stack mode: {mode}")
+    return bands
+
+
+def stack_safe_product(safe_dir, output_dir, bands=None, resolution=10, resampling=Resampling.bilinear,
+                       output_profile='default', mode='tiff'):
+    """
+    Stack every granule of a SAFE product, returning the output files. Outputs are named after the product,
+    with the granule appended for products holding more than one granule.
+    """
+    product_name = os.path.basename(os.path.normpath(safe_dir))[:-len('.SAFE')]
+    extension = '.vrt' if mode == 'vrt' else '.tif'
+    granules = find_granule_bands(safe_dir)
+
+    output_files = []
+    for granule, band_files in granules.items():
+        name = product_name if len(granules) == 1 else f"{product_name}_{granule}"
+        output_file = os.path.join(output_dir, name + extension)
+        stack_granule(band_files, output_file, bands, resolution, resampling, output_profile, mode)
+        output_files.append(output_file)
+    return output_files
+
+
+def stack_sentinel2_products(input_dir, output_dir, bands=None, resolution=10, resampling=Resampling.bilinear,
+                             output_profile='default', mode='tiff', workers=1):
+    """
+    Stack the bands of every SAFE product below input_dir. With workers > 1 products are stacked in parallel
+    on a process pool, each worker writing its own product's outputs.
+    """
+    if not os.path.exists(output_dir):
+        os.makedirs(output_dir)
+
+    safe_dirs = find_safe_products(input_dir)
+    args = (output_dir, bands, resolution, resampling, output_profile, mode)
+    if workers > 1:
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            futures = {executor.submit(stack_safe_product, safe_dir, *args): safe_dir for safe_dir in safe_dirs}
+            for future in tqdm(as_completed(futures), total=len(futures), desc="Stacking Sentinel-2 products"):
+                try:
+                    for output_file in future.result():
+                        tqdm.write(f"Stacked {futures[future]} to {output_file}")
+                except Exception as e:
+                    tqdm.write(f"Error stacking {futures[future]}: {e}")
+    else:
+        for safe_dir in tqdm(safe_dirs, desc="Stacking Sentinel-2 products"):
+            try:
+                for output_file in stack_safe_product(safe_dir, *args):
+                    tqdm.write(f"Stacked {safe_dir} to {output_file}")
+            except Exception as e:
+                tqdm.write(f"Error stacking {safe_dir}: {e}")
+
+
+if __name__ == "__main__":
+    input_directory = r"C:\Users\powelj\Documents\Aotea_test_files\Sentinel\RAW"
+    output_directory = r"C:\Users\powelj\Documents\Aotea_test_files\Sentinel\Stacked"
+    bands = None  # None for every band, or a list such as ['B02', 'B03', 'B04', 'B08']
+    resolution = 10  # Target resolution in metres
+    output_profile = "tiled"  # One of output_profile.OUTPUT_PROFILES: default, tiled, zstd, lzw or cog
+    mode = "tiff"  # 'tiff' to write GeoTIFFs, 'vrt' to write virtual stacks referencing the .jp2 files
+    workers = 4  # Number of SAFE products stacked in parallel
+
+    stack_sentinel2_products(input_directory, output_directory, bands, resolution, Resampling.bilinear,
+                             output_profile, mode, workers)
@@ -0,0 +1,88 @@
+import xml.etree.ElementTree as ET
+import rasterio
+from rasterio.enums import Resampling
+from output_profile import get_output_meta, get_output_windows, finalize_output
+
+# GDAL data type names used in VRT XML
+GDAL_DATA_TYPES = {
+    'uint8': 'Byte',
+    'int8': 'Int8',
+    'uint16': 'UInt16',
+    'int16': 'Int16',
+    'uint32': 'UInt32',
+    'int32': 'Int32',
+    'float32': 'Float32',
+    'float64': 'Float64',
+}
+
+
+def build_stack_vrt(band_files, vrt_path=None, resampling=Resampling.bilinear, descriptions=None,
+                    resolution=None):
+    """
+    Build a GDAL VRT stacking the first band of each file as a band of a virtual multi-band raster, without
+    copying any pixels. The files must cover the same extent in the same CRS. The VRT grid is the first
+    file's, or that extent at the given resolution; files on a different resolution are resampled by GDAL
+    as windows are read.
+
+    Returns the VRT XML, which rasterio.open() accepts directly, and writes it to vrt_path if given.
+    """
+    with rasterio.open(band_files[0]) as src0:
+        crs = src0.crs
+        left, bottom, right, top = src0.bounds
+        x_res, y_res = src0.res if resolution is None else (resolution, resolution)
+        dtype = src0.dtypes[0]
+
+    width = int(round((right - left) / x_res))
+    height = int(round((top - bottom) / y_res))
+
+    root = ET.Element('VRTDataset', rasterXSize=str(width), rasterYSize=str(height))
+    if crs is not None:
+        # Without dataAxisToSRSAxisMapping GDAL reads the SRS in traditional GIS (x, y) order, as rasterio writes
+        # it, whatever the CRS's authority axis order (northing first for EPSG:2193)
+        ET.SubElement(root, 'SRS').text = crs.to_wkt()
+    ET.SubElement(root, 'GeoTransform').text = f"{left!r}, {x_res!r}, 0.0, {top!r}, 0.0, {-y_res!r}"
+
+    for band_index, band_file in enumerate(band_files, start=1):
+        with rasterio.open(band_file) as src:
+            band = ET.SubElement(root, 'VRTRasterBand', dataType=GDAL_DATA_TYPES[dtype], band=str(band_index))
+            if src.nodata is not None:
+                ET.SubElement(band, 'NoDataValue').text = repr(src.nodata)
+            if descriptions is not None:
+                ET.SubElement(band, 'Description').text = descriptions[band_index - 1]
+
+            source = ET.SubElement(band, 'ComplexSource', resampling=resampling.name)
+            ET.SubElement(source, 'SourceFilename', relativeToVRT='0').text = band_file
+            ET.SubElement(source, 'SourceBand').text = '1'
+            block_height, block_width = src.block_shapes[0]
+            ET.SubElement(source, 'SourceProperties', RasterXSize=str(src.width), RasterYSize=str(src.height),
+                          DataType=GDAL_DATA_TYPES[src.dtypes[0]], BlockXSize=str(block_width),
+                          BlockYSize=str(block_height))
+            ET.SubElement(source, 'SrcRect', xOff='0', yOff='0', xSize=str(src.width), ySize=str(src.height))
+            # Place the source on the VRT grid by its bounds
+            ET.SubElement(source, 'DstRect', xOff=repr((src.bounds.left - left) / x_res),
+                          yOff=repr((top - src.bounds.top) / y_res),
+                          xSize=repr((src.bounds.right - src.bounds.left) / x_res),
+                          ySize=repr((src.bounds.top - src.bounds.bottom) / y_res))
+            if src.nodata is not None:
+                ET.SubElement(source, 'NODATA').text = repr(src.nodata)
+
+    vrt_xml = ET.tostring(root, encoding='unicode')
+    if vrt_path is not None:
+        with open(vrt_path, 'w') as f:
+            f.write(vrt_xml)
+    return vrt_xml
+
+
+def materialize_vrt(vrt, output_file, output_profile='default', window_size=1024):
+    """
+    Write a VRT (path or XML) to a GeoTIFF, streaming it block by block so only one window of all bands is
+    held in memory. Outputs use the output_profile's blocks, or rows of window_size for striped outputs.
+    """
+    with rasterio.open(vrt) as src:
+        meta = src.meta.copy()
+        meta.update(driver='GTiff')
+        with rasterio.open(output_file, 'w', **get_output_meta(meta, output_profile)) as dst:
+            for window in get_output_windows(dst, window_size):
+                dst.write(src.read(window=window), window=window)
+            dst.descriptions = src.descriptions
+    finalize_output(output_file, output_profile)